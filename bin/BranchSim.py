@@ -0,0 +1,324 @@
+#!/usr/bin/env -S uv run --script
+
+###########################################
+## BranchSim.py
+##
+## Created: 18 October 2026
+##
+## Purpose: Simulate branch predictors on the branch.log and cfi.log files written by BPRED_LOGGER
+##
+## A component of the CORE-V-WALLY configurable RISC-V project.
+## https://github.com/openhwgroup/cvw
+##
+## Copyright (C) 2021-26 Harvey Mudd College & Oklahoma State University
+##
+## SPDX-License-Identifier: Apache-2.0 WITH SHL-2.1
+##
+## Licensed under the Solderpad Hardware License v 2.1 (the “License”); you may not use this file
+## except in compliance with the License, or, at your option, the Apache License version 2.0. You
+## may obtain a copy of the License at
+##
+## https:##solderpad.org/licenses/SHL-2.1/
+##
+## Unless required by applicable law or agreed to in writing, any work distributed under the
+## License is distributed on an “AS IS” BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+## either express or implied. See the License for the specific language governing permissions
+## and limitations under the License.
+################################################################################################
+
+# how to invoke this simulator:
+# BranchSim.py <log files or directories of .log files> [--predictors ...] [--sizes ...] [-j N]
+# e.g. 'BranchSim.py branch/' on the per-benchmark logs from SeparateBranch.py. It replaces
+# CModelBranchAccuracy.sh and CModelBTBAccuracy.sh and needs no external sim_bp.
+# Each log is decoded once and every predictor and size is simulated from the decoded arrays;
+# the logs are simulated in parallel processes.
+# The log format is BPRED_LOGGER's: '<pc> t|n' per branch (branch.log) or control flow instruction
+# (cfi.log), which also has '<class> <target>'; class is the IClassM bits {call, return, jump, branch}.
+# TRAIN starts a new program with empty predictor state, and when a log has BEGIN records, only the
+# instructions between BEGIN and END are counted.
+# Predictors, after Wally's src/ifu/bpred (size k = log2 of the table entries):
+#   twobit    2^k 2-bit counters indexed by the PC
+#   gshare    2^k 2-bit counters indexed by the PC xor a k-bit global history
+#   global    2^k 2-bit counters indexed by a k-bit global history
+#   local<m>  2^m k-bit local histories indexed by the PC, indexing 2^k 2-bit counters (yehpatt)
+#   btb       2^k-entry untagged BTB; a miss is a taken non-return whose class or target differs from the entry
+#   ras       return address stack of k entries; a miss is a return that doesn't go to the top of the stack
+# btb and ras use the class and target of cfi.log; on logs without them the BTB is keyed by the PC alone
+# and the RAS is skipped. Direction predictors only see branches when the log has classes.
+# The report gives the misprediction rate (%) per log and the geometric mean over the logs as
+# '<predictor><size> <geomean>' lines like CModelBranchAccuracy.sh; --refdata prints the means in
+# the form of parseHPMC.py's RefDataBP and RefDataBTB.
+
+import argparse
+import math
+import os
+import sys
+from multiprocessing import Pool
+
+import numpy as np
+
+PREDICTORS = ('twobit', 'gshare', 'global', 'local4', 'local8', 'local10', 'btb', 'ras')
+CALL, RETURN, JUMP, BRANCH = 8, 4, 2, 1 # IClassM bits
+COUNTERINIT = 1 # 2-bit counters start weakly not taken
+# 2-bit saturating counter transitions for a taken and a not taken branch, as maps of the 4 states
+TAKENMAP = np.array([1, 2, 3, 3], dtype=np.uint8)
+NOTTAKENMAP = np.array([0, 0, 1, 2], dtype=np.uint8)
+
+# the control flow records of a log as arrays
+class Trace:
+    def __init__(self, filename):
+        pcs, taken, classes, targets, programs, counted = [], [], [], [], [], []
+        program = 0
+        sampling = None # whether inside BEGIN/END; None until the first BEGIN
+        with open(filename) as f:
+            for ln in f:
+                lninfo = ln.split()
+                if len(lninfo) < 2 or lninfo[1] not in ('t', 'n'):
+                    if lninfo[:1] == ['TRAIN']:
+                        program += 1
+                    elif lninfo[:1] == ['BEGIN']:
+                        sampling = True
+                    elif lninfo[:1] == ['END']:
+                        sampling = False
+                    continue
+                pcs.append(int(lninfo[0], 16))
+                taken.append(lninfo[1] == 't')
+                if len(lninfo) >= 4:
+                    classes.append(int(lninfo[2], 16))
+                    targets.append(int(lninfo[3], 16))
+                programs.append(program)
+                counted.append(sampling is True)
+        self.name = os.path.basename(filename)
+        self.pcs = np.array(pcs, dtype=np.uint64)
+        self.taken = np.array(taken, dtype=bool)
+        self.programs = np.array(programs, dtype=np.int64)
+        self.counted = np.array(counted, dtype=bool)
+        if sampling is None: # no BEGIN records: count everything
+            self.counted[:] = True
+        self.classes = np.array(classes, dtype=np.uint8) if len(classes) == len(pcs) and pcs else None
+        self.targets = np.array(targets, dtype=np.uint64) if self.classes is not None else None
+
+    # the trace of the branches alone, which is all that direction predictors see
+    def branches(self):
+        if self.classes is None:
+            return self
+        branches = object.__new__(Trace)
+        keep = (self.classes & BRANCH) != 0
+        branches.name = self.name
+        for field in ('pcs', 'taken', 'programs', 'counted', 'classes', 'targets'):
+            setattr(branches, field, getattr(self, field)[keep])
+        return branches
+
+# Wally's PC hash for a k-bit table index: {PC[k+1] ^ PC[1], PC[k:2]}
+def pcindex(pcs, k):
+    low = (pcs >> np.uint64(2)) & np.uint64((1 << (k - 1)) - 1)
+    high = ((pcs >> np.uint64(k + 1)) ^ (pcs >> np.uint64(1))) & np.uint64(1)
+    return (low | (high << np.uint64(k - 1))).astype(np.int64)
+
+# the start index of each record's group in an array sorted by group
+def groupstarts(keys):
+    starts = np.ones(len(keys), dtype=bool)
+    starts[1:] = keys[1:] != keys[:-1]
+    return np.maximum.accumulate(np.where(starts, np.arange(len(keys)), 0))
+
+# the k-bit histories before each record of the outcomes of the previous records of its group
+# (most recent in the top bit, as Wally shifts them in), for every k up to maxbits.
+# keys must be sorted; yields (k, history array).
+def histories(taken, keys, maxbits):
+    starts = groupstarts(keys)
+    index = np.arange(len(taken))
+    history = np.zeros(len(taken), dtype=np.int64)
+    for k in range(1, maxbits + 1):
+        # the k-th previous outcome becomes the new low bit
+        prev = index - k
+        bit = np.zeros(len(taken), dtype=np.int64)
+        valid = prev >= starts
+        bit[valid] = taken[prev[valid]]
+        history = (history << 1) | bit
+        yield k, history
+
+# simulates a table of 2-bit counters: the records of each key share a counter and update it in order.
+# returns whether each record was mispredicted. the counter state before every record is computed at
+# once by a segmented scan composing the records' state transitions, instead of one record at a time;
+# a composition stops early once it maps every state to the same one.
+def counters(keys, taken):
+    order = np.argsort(keys, kind='stable')
+    sortedtaken = taken[order]
+    starts = groupstarts(keys[order])
+    scan = np.where(sortedtaken[:, None], TAKENMAP, NOTTAKENMAP) # transitions of the records so far in the group
+    active = np.arange(len(keys))
+    step = 1
+    while active.size:
+        src = active - step
+        inside = src >= starts[active]
+        active, src = active[inside], src[inside]
+        scan[active] = np.take_along_axis(scan[active], scan[src].astype(np.intp), axis=1)
+        active = active[~(scan[active] == scan[active][:, :1]).all(axis=1)]
+        step *= 2
+    after = scan[:, COUNTERINIT]
+    before = np.empty_like(after)
+    before[0:1] = COUNTERINIT
+    before[1:] = after[:-1]
+    before[starts == np.arange(len(keys))] = COUNTERINIT
+    mispredicted = np.empty(len(keys), dtype=bool)
+    mispredicted[order] = (before >= 2) != sortedtaken
+    return mispredicted
+
+# misprediction counts of a direction predictor for every size
+def direction(trace, predictor, sizes):
+    results = {}
+    if len(trace.pcs) == 0:
+        return {k: (0, 0) for k in sizes}
+    total = int(np.count_nonzero(trace.counted))
+    def record(k, index):
+        mispredicted = counters((trace.programs << np.int64(k)) | index, trace.taken)
+        results[k] = (int(np.count_nonzero(mispredicted & trace.counted)), total)
+
+    if predictor == 'twobit':
+        for k in sizes:
+            record(k, pcindex(trace.pcs, k))
+    elif predictor in ('gshare', 'global'):
+        for k, history in histories(trace.taken, trace.programs, max(sizes)):
+            if k in sizes:
+                record(k, history ^ pcindex(trace.pcs, k) if predictor == 'gshare' else history)
+    else: # local<m>
+        m = int(predictor[len('local'):])
+        lhrkeys = (trace.programs << np.int64(m)) | pcindex(trace.pcs, m)
+        order = np.argsort(lhrkeys, kind='stable')
+        for k, history in histories(trace.taken[order], lhrkeys[order], max(sizes)):
+            if k in sizes:
+                index = np.empty_like(history)
+                index[order] = history
+                record(k, index)
+    return results
+
+# misprediction counts of an untagged direct-mapped BTB for every size: every control flow
+# instruction leaves its class and target in its entry, and a taken non-return misses when
+# the entry it finds holds a different class or target (or PC, for logs without targets)
+def btb(trace, sizes):
+    if trace.classes is not None:
+        considered = trace.taken & ((trace.classes & RETURN) == 0)
+        values = (trace.targets << np.uint64(4)) | trace.classes
+    else:
+        considered = trace.taken
+        values = trace.pcs
+    total = int(np.count_nonzero(considered & trace.counted))
+    results = {}
+    for k in sizes:
+        keys = (trace.programs << np.int64(k)) | pcindex(trace.pcs, k)
+        order = np.argsort(keys, kind='stable')
+        sortedvalues = values[order]
+        first = groupstarts(keys[order]) == np.arange(len(keys))
+        previous = np.zeros_like(sortedvalues)
+        previous[1:] = sortedvalues[:-1]
+        missed = np.empty(len(keys), dtype=bool)
+        missed[order] = first | (previous != sortedvalues)
+        results[k] = (int(np.count_nonzero(missed & considered & trace.counted)), total)
+    return results
+
+# misprediction counts of a circular return address stack of every size in sizes.
+# a call pushes its PC; a return is predicted if its target is 2 or 4 bytes past the top.
+def ras(trace, sizes):
+    calls = ((trace.classes & CALL) != 0).tolist()
+    returns = ((trace.classes & RETURN) != 0).tolist()
+    events = [(i, pc, target) for i, (pc, target, call, ret) in
+              enumerate(zip(trace.pcs.tolist(), trace.targets.tolist(), calls, returns)) if call or ret]
+    programs = trace.programs.tolist()
+    counted = trace.counted.tolist()
+    total = sum(1 for i, _, _ in events if returns[i] and counted[i])
+    results = {}
+    for depth in sizes:
+        stack = [0] * depth
+        pointer = 0
+        program = None
+        misses = 0
+        for i, pc, target in events:
+            if programs[i] != program: # a new program starts with an empty stack
+                program = programs[i]
+                stack = [0] * depth
+                pointer = 0
+            if returns[i]:
+                if counted[i] and target - stack[pointer] not in (2, 4):
+                    misses += 1
+                pointer = (pointer - 1) % depth
+            if calls[i]:
+                pointer = (pointer + 1) % depth
+                stack[pointer] = pc
+        results[depth] = (misses, total)
+    return results
+
+# decodes one log and simulates every predictor and size on it.
+# returns the log name and {(predictor, size): (mispredictions, predictions)}
+def simulate_log(filename, predictors, sizes):
+    trace = Trace(filename)
+    branches = trace.branches()
+    results = {}
+    for predictor in predictors:
+        if predictor == 'btb':
+            counts = btb(trace, sizes)
+        elif predictor == 'ras':
+            if trace.classes is None:
+                continue
+            counts = ras(trace, sizes)
+        else:
+            counts = direction(branches, predictor, sizes)
+        results.update({(predictor, k): count for k, count in counts.items()})
+    return trace.name, results
+
+# the logs named on the command line, with directories standing for the .log files in them
+def logfiles(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.log'))
+        else:
+            files.append(path)
+    return files
+
+# the geometric mean of the misprediction rates (%) of the logs; like CModelBTBAccuracy.sh,
+# a log without mispredictions counts as one misprediction so the mean stays nonzero
+def geomean(counts):
+    logs = [math.log(100 * max(misses, 1) / total) for misses, total in counts if total]
+    return math.exp(sum(logs) / len(logs)) if logs else 0.0
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Simulates branch predictors on BPRED_LOGGER logs.")
+    parser.add_argument('logs', nargs='+', help="branch.log/cfi.log files, or directories of per-benchmark .log files")
+    parser.add_argument('-p', '--predictors', nargs='+', choices=PREDICTORS, default=list(PREDICTORS), metavar='P',
+                        help=f"Predictors to simulate: {', '.join(PREDICTORS)} (default: all)")
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[6, 8, 10, 12, 14, 16], help="log2 of the table entries (RAS entries for ras)")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="Number of logs simulated in parallel")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Report the misprediction rate of every log")
+    parser.add_argument('--refdata', action='store_true', help="Print the geomeans as parseHPMC.py RefDataBP/RefDataBTB entries")
+    return parser.parse_args()
+
+def main(args):
+    files = logfiles(args.logs)
+    if not files:
+        print("Error: no log files to simulate")
+        return 1
+    sizes = sorted(set(args.sizes))
+    with Pool(processes=min(args.jobs, len(files))) as pool:
+        logs = pool.starmap(simulate_log, [(filename, args.predictors, sizes) for filename in files])
+
+    configs = [(predictor, k) for predictor in args.predictors for k in sizes if any((predictor, k) in results for _, results in logs)]
+    if args.verbose:
+        for name, results in logs:
+            for predictor, k in configs:
+                if (predictor, k) in results:
+                    misses, total = results[predictor, k]
+                    rate = 100 * misses / total if total else 0
+                    print(f"{name} {predictor}{k} {misses} of {total} mispredicted ({rate:.4f}%)")
+
+    means = {config: geomean([results[config] for _, results in logs if config in results]) for config in configs}
+    for (predictor, k), mean in means.items():
+        print(f"{predictor}{k} {mean}")
+    if args.refdata:
+        bp = [(f"{predictor}CModel{k}", f"{predictor}CModel", 2**k, 2 * 2**k, mean) for (predictor, k), mean in means.items() if predictor not in ('btb', 'ras')]
+        btbs = [(f"BTBCModel{k}", "BTBCModel", 2**k, 2 * 2**k, mean) for (predictor, k), mean in means.items() if predictor == 'btb']
+        print(f"RefDataBP = {bp}")
+        print(f"RefDataBTB = {btbs}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(parseArgs()))
@@ -40,26 +40,54 @@
 # Add -p or --perf to report the hit/miss ratio.
 # Add -d or --dist to report the distribution of loads, stores, and atomic ops.
 # These distributions may not add up to 100; this is because of flushes or invalidations.
+# Text logs may be gzip or xz compressed; they are decompressed on the fly in a background thread.
+# Add --tobinary <file> to convert a text log into a packed binary trace instead of simulating.
+# -f accepts either format; binary traces are memory mapped, so repeat runs skip the text parsing.
+# -f may also be a named pipe that a running simulation's cache logger writes into (see regression-wally --cache),
+# so the log is checked while it is produced and never stored.
+# Only the first --mismatch-examples result mismatches are printed in full, followed by their counts
+# by Wally/Sim result, set, and test; add --mismatch-file <file> to write all of them with their sets and tests.
+# Add --checkpoint-every N to save the simulation state every N lines, and --resume to continue
+# from the last checkpoint, e.g. after a timeout or with a different -v setting for the tail of the log.
+# Add -j N to simulate the segments between BEGIN/TRAIN records in N parallel processes;
+# each of those records empties the cache, so the results are identical to a serial run.
+# Add --sweep to instead report hits, misses, and writebacks for a grid of --sweeplines x --sweepways
+# configurations from a single pass over the log, e.g. 'CacheSim.py 64 4 56 44 -f <log file> --sweep'.
+# The line size comes from L, A, and T. Use --policy lru for true LRU instead of Wally's pLRU.
+# Add --classify to split the misses into compulsory, capacity, and conflict misses, using a fully-associative
+# LRU cache of the same size as a shadow, and --histogram <prefix> to write per-set access, miss, and
+# miss cause counts to <prefix>.csv and <prefix>.npy; both are collected in the same pass as the simulation.
+# Add --l2 L W T to simulate a run's _ICache.log and _DCache.log together with a shared L2 of the given geometry,
+# e.g. 'CacheSim.py 64 4 56 44 -f <prefix>_DCache.log --l2 1024 8 40'. The L2 sees the L1 misses and writebacks
+# in the order of the cycle stamps that the loggers put at the end of each record.
+# Add --sample-sets K to simulate only K pseudo-randomly chosen sets and estimate the miss rate of the
+# whole cache with a 95% confidence interval; accesses to the other sets are skipped before they are parsed.
 
 import argparse
+import contextlib
+import heapq
+import io
+import itertools
 import math
+import mmap
+import operator
 import os
+import pickle
+import random
+import re
+import shutil
+import stat
+import struct
 import sys
+import tempfile
+from array import array
+from collections import Counter, OrderedDict
+from functools import lru_cache, partial
+from multiprocessing import Pool
 
+import compressedlog
+import numpy as np
 
-class CacheLine:
-    def __init__(self):
-        self.tag = 0
-        self.valid = False
-        self.dirty = False
-
-    def __str__(self):
-        string = f"(V: {self.valid}, D: {self.dirty}"
-        string += f", Tag: {hex(self.tag)})"
-        return string
-
-    def __repr__(self):
-        return self.__str__()
 
 class Cache:
     def __init__(self, numsets, numways, addrlen, taglen):
@@ -70,123 +98,194 @@ class Cache:
         self.taglen = taglen
         self.setlen = int(math.log(numsets, 2))
         self.offsetlen = self.addrlen - self.taglen - self.setlen
+        self.tagshift = self.setlen + self.offsetlen
+        self.tagmask = (1 << self.taglen) - 1
+        self.setmask = (1 << self.setlen) - 1
+        self.offsetmask = (1 << self.offsetlen) - 1
 
-        self.ways = []
-        for i in range(numways):
-            self.ways.append([])
-            for _ in range(numsets):
-                self.ways[i].append(CacheLine())
+        # line state is kept in flat arrays indexed by setnum*numways + waynum
+        # so that every line of a set is contiguous
+        # a line is valid when its valid stamp equals the current valid epoch and dirty when
+        # its dirty stamp equals the current dirty epoch, so invalidating or flushing the whole
+        # cache only has to advance an epoch. epochs start at 1 so a 0 stamp is never current.
+        self.tags = array('Q', [0]) * (numsets * numways)
+        self.validstamps = array('Q', [0]) * (numsets * numways)
+        self.dirtystamps = array('Q', [0]) * (numsets * numways)
+        self.validepoch = 1
+        self.dirtyepoch = 1
+        self.victimtag = 0 # tag of the line most recently evicted by an access
 
-        self.pLRU = []
-        for i in range(self.numsets):
-            self.pLRU.append([0]*(self.numways-1))
+        # each set's pLRU tree is packed into one integer; bit i holds tree node i
+        self.pLRU = array('Q', [0]) * numsets
+        self.pLRUclear, self.pLRUset = self.build_pLRU_masks()
+        self.victimtable = None
+        if numways <= 16:
+            self.victimtable = [self.walk_pLRU(tree) for tree in range(1 << (numways - 1))]
 
-    # flushes the cache by setting all dirty bits to False
+    # flushes the cache by making all dirty stamps stale
     def flush(self):
-        for way in self.ways:
-            for line in way:
-                line.dirty = False
+        self.dirtyepoch += 1
 
     # access a cbo type instruction
     def cbo(self, addr, invalidate):
         tag, setnum, _ = self.splitaddr(addr)
-        for waynum in range(self.numways):
-            line = self.ways[waynum][setnum]
-            if line.tag == tag and line.valid:
-                line.dirty = 0
+        base = setnum * self.numways
+        for line in range(base, base + self.numways):
+            if self.tags[line] == tag and self.validstamps[line] == self.validepoch:
+                self.dirtystamps[line] = 0
                 if invalidate:
-                    line.valid = 0
+                    self.validstamps[line] = 0
 
-    # invalidates the cache by setting all valid bits to False
+    # invalidates the cache by making all valid stamps stale
     def invalidate(self):
-        for way in self.ways:
-            for line in way:
-                line.valid = False
+        self.validepoch += 1
+
+    def isvalid(self, line):
+        return self.validstamps[line] == self.validepoch
+
+    def isdirty(self, line):
+        return self.dirtystamps[line] == self.dirtyepoch
 
-    # resets the pLRU to a fresh 2-D array of 0s
+    # the address of the first byte of a line
+    def lineaddr(self, tag, setnum):
+        return (tag << self.tagshift) | (setnum << self.offsetlen)
+
+    # whether the line holding the given address is in the cache and dirty
+    def isdirtyaddr(self, addr):
+        tag, setnum, _ = self.splitaddr(addr)
+        base = setnum * self.numways
+        return any(self.tags[line] == tag and self.isvalid(line) and self.isdirty(line) for line in range(base, base + self.numways))
+
+    # the addresses of every valid dirty line, which a flush writes back
+    def dirtyaddrs(self):
+        return [self.lineaddr(self.tags[line], line // self.numways) for line in range(self.numsets * self.numways)
+                if self.isvalid(line) and self.isdirty(line)]
+
+    # resets the pLRU of every set to an all-0s tree
     def clear_pLRU(self):
-        self.pLRU = []
-        for _ in range(self.numsets):
-            self.pLRU.append([0]*(self.numways-1))
+        self.pLRU = array('Q', [0]) * self.numsets
 
     # splits the given address into tag, set, and offset
     def splitaddr(self, addr):
         # no need for offset in the sim, but it's here for debug
-        tag = addr >> (self.setlen + self.offsetlen) & int('1'*self.taglen, 2)
-        setnum = (addr >> self.offsetlen) & int('1'*self.setlen, 2)
-        offset = addr & int('1'*self.offsetlen, 2)
+        tag = (addr >> self.tagshift) & self.tagmask
+        setnum = (addr >> self.offsetlen) & self.setmask
+        offset = addr & self.offsetmask
         return tag, setnum, offset
 
+    # splits a whole array of addresses into arrays of tags, sets, and offsets
+    def splitaddrs(self, addrs):
+        addrs = np.asarray(addrs, dtype=np.uint64)
+        tags = (addrs >> np.uint64(self.tagshift)) & np.uint64(self.tagmask)
+        setnums = (addrs >> np.uint64(self.offsetlen)) & np.uint64(self.setmask)
+        offsets = addrs & np.uint64(self.offsetmask)
+        return tags, setnums, offsets
+
     # performs a cache access with the given address.
     # returns a character representing the outcome:
     # H/M/E/D - hit, miss, eviction, or eviction with writeback
     def cacheaccess(self, addr, write=False):
         tag, setnum, _ = self.splitaddr(addr)
+        return self.accessline(tag, setnum, write)
+
+    # performs a run of plain reads/writes (no flushes, invalidations, or cbos)
+    # in order. returns an array of the H/M/E/D outcome of each access.
+    def access_many(self, addrs, writes):
+        tags, setnums, _ = self.splitaddrs(addrs)
+        accessline = self.accessline
+        writes = np.asarray(writes, dtype=bool).tolist()
+        results = [accessline(tag, setnum, write) for tag, setnum, write in zip(tags.tolist(), setnums.tolist(), writes)]
+        return np.array(results, dtype='U1')
+
+    # performs an access to an already split tag and set
+    def accessline(self, tag, setnum, write):
+        tags = self.tags
+        validstamps = self.validstamps
+        dirtystamps = self.dirtystamps
+        validepoch = self.validepoch
+        dirtystamp = self.dirtyepoch if write else 0
+        base = setnum * self.numways
 
         # check our ways to see if we have a hit
-        for waynum in range(self.numways):
-            line = self.ways[waynum][setnum]
-            if line.tag == tag and line.valid:
-                line.dirty = line.dirty or write
-                self.update_pLRU(waynum, setnum)
+        for line in range(base, base + self.numways):
+            if tags[line] == tag and validstamps[line] == validepoch:
+                if write:
+                    dirtystamps[line] = dirtystamp
+                self.update_pLRU(line - base, setnum)
                 return 'H'
 
         # we didn't hit, but we may not need to evict.
         # check for an empty way line.
-        for waynum in range(self.numways):
-            line = self.ways[waynum][setnum]
-            if not line.valid:
-                line.tag = tag
-                line.valid = True
-                line.dirty = write
-                self.update_pLRU(waynum, setnum)
+        for line in range(base, base + self.numways):
+            if validstamps[line] != validepoch:
+                tags[line] = tag
+                validstamps[line] = validepoch
+                dirtystamps[line] = dirtystamp
+                self.update_pLRU(line - base, setnum)
                 return 'M'
 
         # we need to evict. Select a victim and overwrite.
         victim = self.getvictimway(setnum)
-        line = self.ways[victim][setnum]
-        prevdirty = line.dirty
-        line.tag = tag
-        line.valid = True   # technically redundant
-        line.dirty = write
+        line = base + victim
+        prevdirty = dirtystamps[line] == self.dirtyepoch
+        self.victimtag = tags[line]
+        tags[line] = tag
+        validstamps[line] = validepoch   # technically redundant
+        dirtystamps[line] = dirtystamp
         self.update_pLRU(victim, setnum)
         return 'D' if prevdirty else 'E'
 
-    # updates the psuedo-LRU tree for the given set
-    # with an access to the given way
-    def update_pLRU(self, waynum, setnum):
+    # precomputes, for each way, the tree bits an access to that way
+    # touches (clear mask) and the values it leaves them at (set mask)
+    def build_pLRU_masks(self):
+        clearmasks = [0]*self.numways
+        setmasks = [0]*self.numways
         if self.numways == 1:
-            return
+            return clearmasks, setmasks
 
-        tree = self.pLRU[setnum]
         bottomrow = (self.numways - 1)//2
-        index = (waynum // 2) + bottomrow
-        tree[index] = int(not waynum % 2)
-        while index > 0:
-            parent = (index-1) // 2
-            tree[parent] = index % 2
-            index = parent
+        for waynum in range(self.numways):
+            index = (waynum // 2) + bottomrow
+            clearmasks[waynum] |= 1 << index
+            setmasks[waynum] |= int(not waynum % 2) << index
+            while index > 0:
+                parent = (index-1) // 2
+                clearmasks[waynum] |= 1 << parent
+                setmasks[waynum] |= (index % 2) << parent
+                index = parent
+            clearmasks[waynum] = ~clearmasks[waynum] & ((1 << (self.numways - 1)) - 1)
+        return clearmasks, setmasks
+
+    # updates the psuedo-LRU tree for the given set
+    # with an access to the given way
+    def update_pLRU(self, waynum, setnum):
+        self.pLRU[setnum] = (self.pLRU[setnum] & self.pLRUclear[waynum]) | self.pLRUset[waynum]
 
     # uses the psuedo-LRU tree to select
     # a victim way from the given set
     # returns the victim way as an integer
     def getvictimway(self, setnum):
+        if self.victimtable is not None:
+            return self.victimtable[self.pLRU[setnum]]
+        return self.walk_pLRU(self.pLRU[setnum])
+
+    # walks a packed pLRU tree from the root to find its victim way
+    def walk_pLRU(self, tree):
         if self.numways == 1:
             return 0
 
-        tree = self.pLRU[setnum]
         index = 0
         bottomrow = (self.numways - 1) // 2 #first index on the bottom row of the tree
         while index < bottomrow:
-            if tree[index] == 0:
+            if (tree >> index) & 1 == 0:
                 # Go to the left child
                 index = index*2 + 1
-            else: #tree[index] == 1
+            else: #tree bit is 1
                 # Go to the right child
                 index = index*2 + 2
 
         victim = (index - bottomrow)*2
-        if tree[index] == 1:
+        if (tree >> index) & 1:
             victim += 1
 
         return victim
@@ -195,8 +294,10 @@ class Cache:
         string = ""
         for i in range(self.numways):
             string += f"Way {i}: "
-            for line in self.ways[i]:
-                string += f"{line}, "
+            for setnum in range(self.numsets):
+                line = setnum * self.numways + i
+                string += f"(V: {self.isvalid(line)}, D: {self.isdirty(line)}"
+                string += f", Tag: {hex(self.tags[line])}), "
             string += "\n\n"
         return string
 
@@ -204,103 +305,1100 @@ class Cache:
         return self.__str__()
 
 
+# True-LRU model of one set count and several associativities at once.
+# Each set keeps an LRU stack of tags (most recently used first). An access
+# at stack distance d hits in every associativity greater than d, so one pass
+# gives the results of every associativity in waylist (Mattson's stack algorithm).
+# Dirtiness is kept per stack entry as the smallest associativity in which the
+# line is dirty; it is dirty in that and every larger associativity.
+# A cbo invalidation leaves a hole (None) where the line was: every associativity
+# holds the valid lines of its top of the stack, and a miss fills the shallowest
+# hole instead of evicting. The hole moves down to the depth of a line that hits
+# below it, so the results stay exact for traces with cbo.inval/cbo.flush.
+class LRUStack:
+    def __init__(self, numsets, waylist, addrlen, taglen):
+        self.numsets = numsets
+        self.waylist = sorted(waylist)
+        self.maxways = self.waylist[-1]
+        self.clean = self.maxways + 1 # dirtiness that never applies
+
+        self.setlen = int(math.log(numsets, 2))
+        self.offsetlen = addrlen - taglen - self.setlen
+        self.tagshift = self.setlen + self.offsetlen
+        self.tagmask = (1 << taglen) - 1
+        self.setmask = (1 << self.setlen) - 1
+
+        self.hits = [0]*len(self.waylist)
+        self.misses = [0]*len(self.waylist)
+        self.writebacks = [0]*len(self.waylist)
+        self.invalidate()
+
+    def flush(self):
+        self.dirtymins = [[self.clean]*len(stack) for stack in self.stacks]
+
+    def invalidate(self):
+        self.stacks = [[] for _ in range(self.numsets)]
+        self.dirtymins = [[] for _ in range(self.numsets)]
+
+    # there is no replacement state beyond the stacks themselves
+    def clear_pLRU(self):
+        pass
+
+    def cbo(self, addr, invalidate):
+        tag = (addr >> self.tagshift) & self.tagmask
+        setnum = (addr >> self.offsetlen) & self.setmask
+        stack = self.stacks[setnum]
+        if tag in stack:
+            depth = stack.index(tag)
+            self.dirtymins[setnum][depth] = self.clean
+            if invalidate:
+                stack[depth] = None
+
+    # performs a run of plain reads/writes in order, accumulating hits, misses,
+    # and writebacks for every associativity. returns the stack distance of each
+    # access: it hits in the associativities greater than its distance.
+    def access_many(self, addrs, writes):
+        addrs = np.asarray(addrs, dtype=np.uint64)
+        tags = (addrs >> np.uint64(self.tagshift)) & np.uint64(self.tagmask)
+        setnums = (addrs >> np.uint64(self.offsetlen)) & np.uint64(self.setmask)
+        accessline = self.accessline
+        writes = np.asarray(writes, dtype=bool).tolist()
+        depths = [accessline(tag, setnum, write) for tag, setnum, write in zip(tags.tolist(), setnums.tolist(), writes)]
+        return np.array(depths, dtype=np.int64)
+
+    def accessline(self, tag, setnum, write):
+        stack = self.stacks[setnum]
+        dirtymin = self.dirtymins[setnum]
+        found = tag in stack
+        depth = stack.index(tag) if found else self.maxways # misses in every associativity
+        hole = stack.index(None) if None in stack else self.maxways # associativities deeper than this have a free way
+
+        for i, ways in enumerate(self.waylist):
+            if depth < ways:
+                self.hits[i] += 1
+            else:
+                self.misses[i] += 1
+                # a full set evicts the line at depth ways-1
+                if ways <= hole and len(stack) >= ways and dirtymin[ways-1] <= ways:
+                    self.writebacks[i] += 1
+
+        if found:
+            prevdirtymin = dirtymin[depth]
+            # associativities that missed bring the line in clean
+            newdirtymin = 1 if write else max(prevdirtymin, depth + 1)
+            if hole < depth: # the misses filled the hole; the hits keep the line's way free of other lines
+                stack[depth] = None
+                dirtymin[depth] = self.clean
+                del stack[hole]
+                del dirtymin[hole]
+            else:
+                del stack[depth]
+                del dirtymin[depth]
+        else:
+            newdirtymin = 1 if write else self.clean
+            if hole < len(stack):
+                del stack[hole]
+                del dirtymin[hole]
+            elif len(stack) == self.maxways:
+                stack.pop()
+                dirtymin.pop()
+        stack.insert(0, tag)
+        dirtymin.insert(0, newdirtymin)
+        return depth
+
+
+# ops in the log that are not plain reads/writes
+CONTROLOPS = ('F', 'I', 'V', 'L', 'C')
+# maximum number of accesses simulated together by Cache.access_many
+BATCHSIZE = 65536
+# maximum number of lines/records read at a time between checkpoints
+CHECKPOINTCHUNK = 1 << 20
+# write buffer size for the --mismatch-file detail log
+DETAILBUFFER = 1 << 20
+# number of entries printed for each mismatch breakdown
+MISMATCHTOP = 10
+
+# binary trace format written by --tobinary: a header, the packed records, an index of
+# the BEGIN/TRAIN/END markers, and the marker names (e.g. the memfile), one per line.
+# ops and results keep their log characters; BEGIN/TRAIN/END are kept in the
+# record stream as ops 'B'/'T'/'E' so the record order matches the log.
+TRACEMAGIC = b'WALLYCT1'
+TRACEHEADER = struct.Struct('<8sQQI4x') # magic, number of records, number of markers, hex digits per address
+TRACERECORD = np.dtype([('addr', '<u8'), ('op', 'S1'), ('result', 'S1')])
+TRACEMARKER = np.dtype([('record', '<u8'), ('kind', 'S1')])
+MARKERS = {'BEGIN': b'B', 'TRAIN': b'T', 'END': b'E'}
+MARKERNAMES = {code: name for name, code in MARKERS.items()}
+TRACECONTROLS = np.array([op.encode() for op in CONTROLOPS] + list(MARKERNAMES), dtype='S1')
+TRACEWRITES = np.array([b'W', b'A', b'Z'], dtype='S1')
+MARKERTEXT = tuple(MARKERS)
+# ops that only touch the set of their address, so --sample-sets can skip them
+SETOPS = ('R', 'W', 'A', 'Z', 'V', 'L', 'C')
+# most low address hex digits that --sample-sets filters with a lookup of every digits/op combination
+SAMPLEDIGITS = 4
+
+# a deterministic pseudo-random subset of the sets of a cache. only the accesses to
+# these sets are simulated, and the miss rate is extrapolated to the whole cache.
+class SetSampler:
+    def __init__(self, numsets, numsampled, offsetlen):
+        self.numsets = numsets
+        self.sets = sorted(random.Random(numsets).sample(range(numsets), numsampled))
+        self.offsetlen = offsetlen
+        self.setmask = numsets - 1
+        self.sampled = np.zeros(numsets, dtype=bool)
+        self.sampled[self.sets] = True
+
+        # the hex digits of a logged address, counted from its end, that hold the set
+        # bits, and every value of them that selects a sampled set, so lines can be
+        # skipped by a string lookup before any int conversion
+        setlen = int(math.log(numsets, 2))
+        self.lodigit = offsetlen // 4
+        self.hidigit = -(-(offsetlen + setlen) // 4)
+        numdigits = self.hidigit - self.lodigit
+        shift = offsetlen - 4*self.lodigit
+        windows = [f"{window:0{numdigits}x}" for window in range(16**numdigits) if self.sampled[(window >> shift) & self.setmask]]
+        self.windows = frozenset(windows + [window.upper() for window in windows])
+        # the last hidigit digits of the address followed by the op of every access or cbo
+        # to an unsampled set, e.g. '3f8 R ', so lines with a fixed-width address can be
+        # filtered without a Python loop
+        self.skipped = None
+        if self.hidigit <= SAMPLEDIGITS:
+            self.skipped = frozenset(f"{digits:0{self.hidigit}x} {op} " for digits in range(16**self.hidigit) for op in SETOPS
+                                     if not self.sampled[(digits >> offsetlen) & self.setmask])
+
+    # yields the log lines that are not accesses or cbos to unsampled sets
+    def filter(self, lines):
+        if len(self.sets) == self.numsets:
+            yield from lines
+            return
+        if self.skipped is None:
+            yield from self.filterlines(lines)
+            return
+        lines = iter(lines)
+        skipped = self.skipped
+        addrlen = None # hex digits in the logged addresses, from the first access
+        for chunk in iter(lambda: list(itertools.islice(lines, BATCHSIZE)), []):
+            if addrlen is None:
+                addrlen = self.addresslength(chunk)
+                if addrlen is None:
+                    yield from self.filterlines(chunk)
+                    continue
+            # markers and flushes don't have an address followed by an op at these columns
+            digitsop = operator.itemgetter(slice(addrlen - self.hidigit, addrlen + 3))
+            yield from itertools.compress(chunk, map(operator.not_, map(skipped.__contains__, map(digitsop, chunk))))
+
+    # the length of the first logged address long enough to hold the set bits
+    def addresslength(self, lines):
+        for ln in lines:
+            end = ln.find(' ')
+            if end >= self.hidigit and ln[end + 1:end + 2] in SETOPS and not ln.startswith(MARKERTEXT):
+                return end
+        return None
+
+    # filter for any address format, one line at a time
+    def filterlines(self, lines):
+        windows, lo, hi = self.windows, self.lodigit, self.hidigit
+        for ln in lines:
+            end = ln.find(' ') # end of the address
+            window = ln[end - hi:end - lo] if end >= hi else ln[:max(end - lo, 0)].rjust(hi - lo, '0')
+            if window in windows or ln[end + 1:end + 2] not in SETOPS or ln.startswith(MARKERTEXT):
+                yield ln
+
+    # which of an array of addresses fall in sampled sets
+    def keep(self, addrs):
+        return self.sampled[(np.asarray(addrs, dtype=np.uint64) >> np.uint64(self.offsetlen)) & np.uint64(self.setmask)]
+
+    # estimates the miss rate of the whole cache from the access and miss counts of
+    # the sampled sets (ratio estimator over a sample of sets drawn without replacement).
+    # returns the rate and the half-width of its 95% confidence interval.
+    def estimate(self, accesses, misses):
+        accesses = np.asarray(accesses, dtype=float)
+        misses = np.asarray(misses, dtype=float)
+        numsampled = len(accesses)
+        if accesses.sum() == 0:
+            return 0.0, 0.0
+        rate = misses.sum() / accesses.sum()
+        if numsampled < 2:
+            return rate, math.inf
+        residual = ((misses - rate*accesses)**2).sum() / (numsampled - 1)
+        variance = (1 - numsampled/self.numsets) * residual / (numsampled * accesses.mean()**2)
+        return rate, 1.96*math.sqrt(variance)
+
+# SetSampler for a geometry, shared by every segment and batch of the run
+@lru_cache
+def setsampler(numsets, numsampled, offsetlen):
+    return SetSampler(numsets, numsampled, offsetlen)
+
+# SetSampler of the simulated cache for --sample-sets, or None
+def argsampler(args):
+    if not args.sample_sets:
+        return None
+    return setsampler(args.numlines, args.sample_sets, args.addrlen - args.taglen - int(math.log(args.numlines, 2)))
+
+# classifies the misses of a cache as compulsory (the first access to the line since the
+# cache was emptied), capacity (also a miss in a fully-associative LRU cache of the same
+# size), or conflict (every other miss), counting them per set
+class MissClassifier:
+    KINDS = ('compulsory', 'capacity', 'conflict')
+
+    def __init__(self, numsets, numways, offsetlen):
+        self.capacity = numsets * numways
+        self.offsetlen = offsetlen
+        self.counts = np.zeros((numsets, len(self.KINDS)), dtype=np.int64)
+        self.invalidate()
+
+    # empties the shadow cache; the next access to every line is compulsory
+    def invalidate(self):
+        self.seen = set()
+        self.shadow = OrderedDict() # fully-associative LRU lines, least recently used first
+
+    # a cbo invalidation of one line
+    def remove(self, addr):
+        line = addr >> self.offsetlen
+        self.seen.discard(line)
+        self.shadow.pop(line, None)
+
+    # shadows a run of accesses given their addresses, sets, and H/M/E/D results
+    def access_many(self, addrs, setnums, results):
+        seen, shadow, capacity = self.seen, self.shadow, self.capacity
+        missed, kinds = [], []
+        lines = (np.asarray(addrs, dtype=np.uint64) >> np.uint64(self.offsetlen)).tolist()
+        for i, (line, result) in enumerate(zip(lines, np.asarray(results).tolist())):
+            shadowhit = line in shadow
+            if shadowhit:
+                shadow.move_to_end(line)
+            else:
+                shadow[line] = None
+                if len(shadow) > capacity:
+                    shadow.popitem(last=False)
+            if result != 'H':
+                missed.append(i)
+                kinds.append(0 if line not in seen else 2 if shadowhit else 1)
+            seen.add(line)
+        np.add.at(self.counts, (np.asarray(setnums, dtype=np.intp)[missed], kinds), 1)
+
+    def merge(self, other):
+        self.counts += other.counts
+
+# the Stats of a run, with the per-set counts and miss classification that the args ask for
+def newstats(args):
+    stats = Stats(args.numlines if args.sample_sets or args.histogram else None)
+    if args.classify:
+        stats.classifier = MissClassifier(args.numlines, args.numways, args.addrlen - args.taglen - int(math.log(args.numlines, 2)))
+    return stats
+
+# writes the per-set access, miss, and miss classification counts
+# to <prefix>.csv and the same table as a NumPy array to <prefix>.npy
+def writehistogram(prefix, stats):
+    columns = ['accesses', 'misses']
+    table = [stats.setaccesses, stats.setmisses]
+    if stats.classifier:
+        columns += MissClassifier.KINDS
+        table += list(stats.classifier.counts.T)
+    table = np.column_stack([np.arange(len(stats.setaccesses)), *table])
+    np.savetxt(f"{prefix}.csv", table, fmt='%d', delimiter=',', header=','.join(['set', *columns]), comments='')
+    np.save(f"{prefix}.npy", table)
+
+class Stats:
+    # numsets keeps per-set access and miss counts for --sample-sets and --histogram
+    def __init__(self, numsets=None):
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.stores = 0
+        self.atoms = 0
+        self.totalops = 0
+        self.mismatches = 0
+        self.test = 0 # number of BEGIN/TRAIN records seen so far
+        self.testnames = {}
+        self.bypair = Counter() # mismatches by Wally's and the sim's result, e.g. 'HM'
+        self.byset = Counter()
+        self.bytest = Counter()
+        self.examples = [] # the first mismatch messages
+        self.detail = None # --mismatch-file writer
+        self.detailoffset = 0 # size of the --mismatch-file at the last checkpoint
+        self.setaccesses = None if numsets is None else np.zeros(numsets, dtype=np.int64)
+        self.setmisses = None if numsets is None else np.zeros(numsets, dtype=np.int64)
+        self.classifier = None # MissClassifier for --classify
+
+    # the open --mismatch-file is not part of the saved or transferred state
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['detail'] = None
+        return state
+
+    # counts mismatches by result pair (an array of Wally's result + the sim's result) and set
+    def countmismatches(self, pairs, setnums):
+        self.mismatches += len(pairs)
+        self.bytest[self.test] += len(pairs)
+        for counts, keys in ((self.bypair, pairs), (self.byset, setnums)):
+            values, numkeys = np.unique(keys, return_counts=True)
+            counts.update(dict(zip(values.tolist(), numkeys.tolist())))
+
+    # keeps the first mismatches as examples and writes every one to the detail log
+    def logmismatch(self, args, addrstr, setnum, expected, result):
+        message = f"Result mismatch at address {addrstr}. Wally: {expected}, Sim: {result}"
+        if len(self.examples) < args.mismatch_examples:
+            self.examples.append(message)
+        if self.detail:
+            self.detail.write(f"{message} (set {hex(setnum)}, test {self.testname(self.test)})\n")
+
+    def testname(self, test):
+        return f"{test} {self.testnames[test]}" if test in self.testnames else str(test)
+
+    # reports the distribution, hit/miss ratio, and mismatch summary for the run
+    def report(self, args):
+        if self.mismatches:
+            if not args.verbose: # verbose mode already printed every mismatch
+                for message in self.examples[:args.mismatch_examples]:
+                    print(message)
+                if self.mismatches > args.mismatch_examples:
+                    print(f"... {self.mismatches - args.mismatch_examples} more mismatches not shown" +
+                          (f"; all are listed in {args.mismatch_file}" if args.mismatch_file else ""))
+            print(f"There were {self.mismatches} mismatches between Wally and the sim.")
+            print("Mismatches by Wally/Sim result:", ", ".join(f"{pair[0]}/{pair[1:]}: {count}" for pair, count in self.bypair.most_common()))
+            print("Mismatches by set:", ", ".join(f"{hex(setnum)}: {count}" for setnum, count in self.byset.most_common(MISMATCHTOP)))
+            print("Mismatches by test:", ", ".join(f"{self.testname(test)}: {count}" for test, count in self.bytest.most_common(MISMATCHTOP)))
+
+        if args.dist:
+            percent_loads = str(round(100*self.loads/self.totalops))
+            percent_stores = str(round(100*self.stores/self.totalops))
+            percent_atoms = str(round(100*self.atoms/self.totalops))
+            print(f"This log had {percent_loads}% loads, {percent_stores}% stores, and {percent_atoms}% atomic operations.")
+
+        if args.perf:
+            ratio = round(self.hits/self.misses,3)
+            print("There were", self.hits, "hits and", self.misses, "misses. The hit/miss ratio was", str(ratio)+".")
+
+        if self.classifier:
+            kinds = self.classifier.counts.sum(axis=0).tolist()
+            total = sum(kinds)
+            print("Misses by cause:", ", ".join(f"{count} {kind} ({100*count/total if total else 0:.1f}%)"
+                                                  for kind, count in zip(MissClassifier.KINDS, kinds)) + ".")
+
+        sampler = argsampler(args)
+        if sampler and self.setaccesses is not None:
+            rate, halfwidth = sampler.estimate(self.setaccesses[sampler.sets], self.setmisses[sampler.sets])
+            scale = sampler.numsets / len(sampler.sets)
+            print(f"Sampled {len(sampler.sets)} of {sampler.numsets} sets: the estimated miss rate is {100*rate:.3f}% "
+                  f"+/- {100*halfwidth:.3f}% (95% confidence), about {round(self.hits*scale)} hits and "
+                  f"{round(self.misses*scale)} misses over all sets.")
+
+        if self.mismatches == 0:
+            print("SUCCESS! There were no mismatches between Wally and the sim.")
+
+    # adds in the counts from another run, e.g. a later segment of the same log
+    def merge(self, other):
+        self.hits += other.hits
+        self.misses += other.misses
+        self.loads += other.loads
+        self.stores += other.stores
+        self.atoms += other.atoms
+        self.totalops += other.totalops
+        self.mismatches += other.mismatches
+        self.test = other.test
+        self.testnames.update(other.testnames)
+        self.bypair.update(other.bypair)
+        self.byset.update(other.byset)
+        self.bytest.update(other.bytest)
+        self.examples.extend(other.examples)
+        if self.setaccesses is not None:
+            self.setaccesses += other.setaccesses
+            self.setmisses += other.setmisses
+        if self.classifier:
+            self.classifier.merge(other.classifier)
+
+
+# read-only view of a binary trace through memory maps
+class BinaryTrace:
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            _, numrecords, nummarkers, self.addrdigits = TRACEHEADER.unpack(f.read(TRACEHEADER.size))
+            markeroffset = TRACEHEADER.size + numrecords * TRACERECORD.itemsize
+            f.seek(markeroffset + nummarkers * TRACEMARKER.itemsize)
+            names = f.read().decode().split('\n')
+        self.records = self.mapped(filename, TRACERECORD, TRACEHEADER.size, numrecords)
+        self.markers = self.mapped(filename, TRACEMARKER, markeroffset, nummarkers)
+        self.names = dict(zip(self.markers['record'].tolist(), names))
+
+    @staticmethod
+    def mapped(filename, dtype, offset, count):
+        if count == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+    def __len__(self):
+        return len(self.records)
+
+    def addrstr(self, addr):
+        return f"{addr:0{self.addrdigits}x}"
+
+    # the record range of every segment, split at the BEGIN/TRAIN markers
+    def segments(self):
+        starts = self.markers['record'][np.isin(self.markers['kind'], [b'B', b'T'])].tolist()
+        if not starts or starts[0] != 0:
+            starts.insert(0, 0)
+        return list(zip(starts, [*starts[1:], len(self)]))
+
+    # rebuilds the split log line of a record
+    def lninfo(self, index):
+        addr, op, result = self.records[index].tolist()
+        if op in MARKERNAMES:
+            return [MARKERNAMES[op], *self.names.get(index, '').split()]
+        return [self.addrstr(addr), op.decode(), result.decode()]
+
+    # yields the log lines of a range of records
+    def lines(self, start, end):
+        for index in range(start, end):
+            yield ' '.join(self.lninfo(index))
+
+# checks for a named pipe, e.g. a log being streamed from a running simulation
+def isfifo(filename):
+    return stat.S_ISFIFO(os.stat(filename).st_mode)
+
+# returns the decompressor for a .gz or .xz log, or None for anything else
+def compressedopener(filename):
+    if isfifo(filename):
+        return None
+    return compressedlog.compressedopener(filename)
+
+# opens a text log, decompressing it in a background thread if it is compressed
+def openlog(filename):
+    if isfifo(filename):
+        return open(filename)
+    return compressedlog.openlog(filename)
+
+# checks for the binary trace magic number. pipes are always read as text logs
+# because peeking at them would consume the start of the stream.
+def isbinarytrace(filename):
+    if isfifo(filename):
+        return False
+    with open(filename, 'rb') as f:
+        return f.read(len(TRACEMAGIC)) == TRACEMAGIC
+
+# converts a text I$/D$ log into the binary trace format
+def writebinary(f, outname):
+    markers = []
+    names = []
+    numrecords = 0
+    addrdigits = 0
+    with open(outname, 'wb') as out:
+        out.write(TRACEHEADER.pack(TRACEMAGIC, 0, 0, 0))
+        for kind, record in readrecords(f):
+            if kind == 'access':
+                addrstrs, ops, expected = record
+                chunk = np.empty(len(addrstrs), dtype=TRACERECORD)
+                chunk['addr'] = [int(a, 16) for a in addrstrs]
+                chunk['op'] = ops
+                chunk['result'] = expected
+                addrdigits = addrdigits or len(addrstrs[0])
+            elif len(record) >= 3:
+                chunk = np.array([(int(record[0], 16), record[1], record[2])], dtype=TRACERECORD)
+            elif record and record[0] in MARKERS:
+                markers.append((numrecords, MARKERS[record[0]]))
+                names.append(' '.join(record[1:]))
+                chunk = np.array([(0, MARKERS[record[0]], b'X')], dtype=TRACERECORD)
+            else: # blank line
+                continue
+            out.write(chunk.tobytes())
+            numrecords += len(chunk)
+        out.write(np.array(markers, dtype=TRACEMARKER).tobytes())
+        out.write('\n'.join(names).encode())
+        out.seek(0)
+        out.write(TRACEHEADER.pack(TRACEMAGIC, numrecords, len(markers), addrdigits))
+
+
 def parseArgs():
     parser = argparse.ArgumentParser(description="Simulates a L1 cache.")
     parser.add_argument('numlines', type=int, help="The number of lines per way (a power of 2)", metavar="L")
     parser.add_argument('numways', type=int, help="The number of ways (a power of 2)", metavar='W')
     parser.add_argument('addrlen', type=int, help="Length of the address in bits (a power of 2)", metavar="A")
     parser.add_argument('taglen', type=int, help="Length of the tag in bits", metavar="T")
-    parser.add_argument('-f', "--file", required=True, help="Log file to simulate from")
+    parser.add_argument('-f', "--file", required=True, help="Log file to simulate from: text (optionally .gz/.xz compressed) or a binary trace from --tobinary")
     parser.add_argument('-v', "--verbose", action='store_true', help="verbose/full-trace mode")
     parser.add_argument('-p', "--perf", action='store_true', help="Report hit/miss ratio")
     parser.add_argument('-d', "--dist", action='store_true', help="Report distribution of operations")
+    parser.add_argument('-j', "--jobs", type=int, default=1, help="Simulate the log's BEGIN/TRAIN segments in this many parallel processes (ignored for pipes and compressed logs)")
+    parser.add_argument("--reference", action='store_true', help="Simulate one access at a time instead of in batches (slow reference mode)")
+    parser.add_argument("--sweep", action='store_true', help="Report hits/misses/writebacks for a grid of lines x ways in one pass; L and T only set the line size")
+    parser.add_argument("--sweeplines", type=int, nargs='+', default=[16, 32, 64, 128, 256], help="Lines per way to sweep (powers of 2)", metavar="L")
+    parser.add_argument("--sweepways", type=int, nargs='+', default=[1, 2, 4, 8], help="Numbers of ways to sweep (powers of 2)", metavar="W")
+    parser.add_argument("--mismatch-examples", type=int, default=10, metavar="N", help="Print only the first N result mismatches in full (default 10); the rest are counted by result, set, and test")
+    parser.add_argument("--mismatch-file", metavar="FILE", help="Write every result mismatch with its set and test to FILE")
+    parser.add_argument("--sample-sets", type=int, metavar="K", help="Simulate only K pseudo-randomly chosen sets (of the smallest --sweeplines for --sweep) and extrapolate the miss rate")
+    parser.add_argument("--l2", type=int, nargs=3, metavar=("L", "W", "T"), help="Simulate the I$ and D$ logs of a run together with a shared L2 of L lines per way, W ways, and T tag bits; -f is the D$ log")
+    parser.add_argument("--ifile", help="I$ log for --l2 (default: the -f path with DCache replaced by ICache)")
+    parser.add_argument("--icache", type=int, nargs=3, metavar=("L", "W", "T"), help="I$ geometry for --l2 (default: the same as the D$)")
+    parser.add_argument("--classify", action='store_true', help="Classify misses as compulsory, capacity, or conflict")
+    parser.add_argument("--histogram", metavar="PREFIX", help="Write per-set access and miss counts (and --classify counts) to PREFIX.csv and PREFIX.npy")
+    parser.add_argument("--checkpoint-every", type=int, metavar="N", help="Save the simulation state to the checkpoint file after every N lines (records for binary traces)")
+    parser.add_argument("--checkpoint", metavar="FILE", help="Checkpoint file (default: <log file>.ckpt)")
+    parser.add_argument("--resume", action='store_true', help="Continue from the state saved in the checkpoint file")
+    parser.add_argument("--tobinary", metavar="OUT", help="Convert the text log to a binary trace in OUT instead of simulating")
+    parser.add_argument("--policy", choices=["plru", "lru"], default="plru", help="Replacement policy for --sweep: Wally's tree pLRU or true LRU via stack distances")
     return parser.parse_args()
 
-def main(args):
+# handles a log line that is not a plain read/write:
+# test boundaries, flushes, invalidations, and cbos
+def control(cache, lninfo, args, stats):
+    if len(lninfo) < 3: #non-address line
+        if len(lninfo) > 0 and (lninfo[0] == 'BEGIN' or lninfo[0] == 'TRAIN'):
+            # currently BEGIN and END traces aren't being recorded correctly
+            # trying TRAIN clears instead
+            cache.invalidate() # a new test is starting, so 'empty' the cache
+            cache.clear_pLRU()
+            if stats.classifier:
+                stats.classifier.invalidate()
+            stats.test += 1
+            if len(lninfo) > 1:
+                stats.testnames[stats.test] = lninfo[1]
+            if args.verbose:
+                print("New Test")
+        return
+
+    stats.totalops += 1
+    if lninfo[1] == 'F':
+        cache.flush()
+        if args.verbose:
+            print("F")
+    elif lninfo[1] == 'I':
+        cache.invalidate()
+        if stats.classifier:
+            stats.classifier.invalidate()
+        if args.verbose:
+            print("I")
+    else: # V, L, or C
+        addr = int(lninfo[0], 16)
+        IsCBOClean = lninfo[1] != 'C'
+        cache.cbo(addr, IsCBOClean)
+        if stats.classifier and IsCBOClean:
+            stats.classifier.remove(addr)
+        if args.verbose:
+            print(lninfo[1])
+
+# prints the verbose trace line and mismatch message for one access
+def reportaccess(cache, args, addrstr, op, expected, result):
+    addr = int(addrstr, 16)
+    tag, setnum, offset = cache.splitaddr(addr)
+    print(hex(addr), hex(tag), hex(setnum), hex(offset), expected, result)
+    if result != expected:
+        print(f"Result mismatch at address {addrstr}. Wally: {expected}, Sim: {result}")
+
+# simulates the log one line at a time with Cache.cacheaccess
+def simulate_reference(cache, f, args, stats):
+    sampler = argsampler(args)
+    for ln in (sampler.filter(f) if sampler else f):
+        lninfo = ln.split()
+        if len(lninfo) < 3 or lninfo[1] in CONTROLOPS:
+            control(cache, lninfo, args, stats)
+            continue
+
+        addr = int(lninfo[0], 16)
+        iswrite = lninfo[1] == 'W' or lninfo[1] == 'A' or lninfo[1] == 'Z'
+        result = cache.cacheaccess(addr, iswrite)
+        tallyaccess(cache, args, stats, lninfo, addr, result)
+
+# counts and reports the result of one plain read/write
+def tallyaccess(cache, args, stats, lninfo, addr, result):
+    stats.totalops += 1
+    if args.verbose:
+        reportaccess(cache, args, lninfo[0], lninfo[1], lninfo[2], result)
+
+    if result == 'H':
+        stats.hits += 1
+    else:
+        stats.misses += 1
+    if stats.setaccesses is not None:
+        setnum = cache.splitaddr(addr)[1]
+        stats.setaccesses[setnum] += 1
+        stats.setmisses[setnum] += result != 'H'
+    if stats.classifier:
+        stats.classifier.access_many([addr], [cache.splitaddr(addr)[1]], [result])
+    if lninfo[1] == 'R':
+        stats.loads += 1
+    elif lninfo[1] == 'W':
+        stats.stores += 1
+    elif lninfo[1] == 'A':
+        stats.atoms += 1
+    if result != lninfo[2]:
+        setnum = cache.splitaddr(addr)[1]
+        stats.countmismatches([lninfo[2] + result], [setnum])
+        stats.logmismatch(args, lninfo[0], setnum, lninfo[2], result)
+
+# reads the log, yielding ('access', (addrstrs, ops, expected)) for every run of
+# at most BATCHSIZE plain reads/writes and ('control', lninfo) for every other record
+def readrecords(f):
+    addrstrs, ops, expected = [], [], [] # address strings, ops, and Wally's results
+    for ln in f:
+        lninfo = ln.split()
+        if len(lninfo) < 3 or lninfo[1] in CONTROLOPS:
+            if addrstrs:
+                yield 'access', (addrstrs, ops, expected)
+                addrstrs, ops, expected = [], [], []
+            yield 'control', lninfo
+            continue
+
+        addrstrs.append(lninfo[0])
+        ops.append(lninfo[1])
+        expected.append(lninfo[2])
+        if len(addrstrs) >= BATCHSIZE:
+            yield 'access', (addrstrs, ops, expected)
+            addrstrs, ops, expected = [], [], []
+    if addrstrs:
+        yield 'access', (addrstrs, ops, expected)
+
+# converts a batch of address strings and ops into the arrays Cache.access_many takes
+def decodebatch(addrstrs, ops):
+    addrs = np.array([int(a, 16) for a in addrstrs], dtype=np.uint64)
+    writes = np.array([op == 'W' or op == 'A' or op == 'Z' for op in ops], dtype=bool)
+    return addrs, writes
+
+# counts and reports the results of a batch of plain reads/writes.
+# addrs, ops, expected, and results are arrays; addrstr gives the logged address of an access.
+def tallybatch(cache, args, stats, addrs, ops, expected, results, addrstr):
+    numhits = int(np.count_nonzero(results == 'H'))
+    stats.hits += numhits
+    stats.misses += len(results) - numhits
+    stats.totalops += len(ops)
+    stats.loads += int(np.count_nonzero(ops == 'R'))
+    stats.stores += int(np.count_nonzero(ops == 'W'))
+    stats.atoms += int(np.count_nonzero(ops == 'A'))
+    if stats.setaccesses is not None or stats.classifier:
+        setnums = cache.splitaddrs(addrs)[1].astype(np.intp)
+    if stats.setaccesses is not None:
+        stats.setaccesses += np.bincount(setnums, minlength=len(stats.setaccesses))
+        stats.setmisses += np.bincount(setnums, weights=results != 'H', minlength=len(stats.setmisses)).astype(np.int64)
+    if stats.classifier:
+        stats.classifier.access_many(addrs, setnums, results)
+
+    if args.verbose:
+        for i in range(len(results)):
+            reportaccess(cache, args, addrstr(i), str(ops[i]), str(expected[i]), str(results[i]))
+    mismatched = np.flatnonzero(results != expected)
+    if len(mismatched) == 0:
+        return
+    setnums = cache.splitaddrs(addrs[mismatched])[1]
+    stats.countmismatches(np.char.add(expected[mismatched], results[mismatched]), setnums)
+    # only the mismatches that are printed or written to the detail log need their messages formatted
+    logged = len(mismatched) if stats.detail else max(0, args.mismatch_examples - len(stats.examples))
+    for i, setnum in zip(mismatched[:logged].tolist(), setnums[:logged].tolist()):
+        stats.logmismatch(args, addrstr(i), setnum, str(expected[i]), str(results[i]))
+
+# simulates a run of plain reads/writes with Cache.access_many
+def runbatch(cache, batch, args, stats):
+    addrstrs, ops, expected = batch
+    addrs, writes = decodebatch(addrstrs, ops)
+    results = cache.access_many(addrs, writes)
+    tallybatch(cache, args, stats, addrs, np.array(ops), np.array(expected), results, addrstrs.__getitem__)
+
+# simulates the records of a binary trace between start and end in batches
+def simulate_binary(cache, trace, args, stats, start, end):
+    sampler = argsampler(args)
+    ops = trace.records['op'][start:end]
+    controls = (np.flatnonzero(np.isin(ops, TRACECONTROLS)) + start).tolist()
+    prev = start
+    for index in [*controls, end]:
+        for batchstart in range(prev, index, BATCHSIZE):
+            run = trace.records[batchstart:min(index, batchstart + BATCHSIZE)]
+            if sampler:
+                run = run[sampler.keep(run['addr'])]
+            addrs = run['addr']
+            results = cache.access_many(addrs, np.isin(run['op'], TRACEWRITES))
+            tallybatch(cache, args, stats, addrs, run['op'].astype('U1'), run['result'].astype('U1'), results,
+                       lambda i, addrs=addrs: trace.addrstr(int(addrs[i])))
+        if index < end:
+            control(cache, trace.lninfo(index), args, stats)
+        prev = index + 1
+
+# simulates the log in batches of plain reads/writes separated by control records
+def simulate_batched(cache, f, args, stats):
+    sampler = argsampler(args)
+    for kind, record in readrecords(sampler.filter(f) if sampler else f):
+        if kind == 'access':
+            runbatch(cache, record, args, stats)
+        else:
+            control(cache, record, args, stats)
+
+# yields ('access', (addrs, writes)) arrays for every run of plain reads/writes
+# and ('control', lninfo) for every other record of a text log or binary trace,
+# leaving out the accesses to the sets that the optional SetSampler skips
+def decodedrecords(filename, sampler=None):
+    if isbinarytrace(filename):
+        trace = BinaryTrace(filename)
+        controls = np.flatnonzero(np.isin(trace.records['op'], TRACECONTROLS)).tolist()
+        prev = 0
+        for index in [*controls, len(trace)]:
+            for batchstart in range(prev, index, BATCHSIZE):
+                run = trace.records[batchstart:min(index, batchstart + BATCHSIZE)]
+                if sampler:
+                    run = run[sampler.keep(run['addr'])]
+                yield 'access', (np.asarray(run['addr'], dtype=np.uint64), np.isin(run['op'], TRACEWRITES))
+            if index < len(trace):
+                yield 'control', trace.lninfo(index)
+            prev = index + 1
+    else:
+        with openlog(filename) as f:
+            for kind, record in readrecords(sampler.filter(f) if sampler else f):
+                if kind == 'access':
+                    yield kind, decodebatch(record[0], record[1])
+                else:
+                    yield kind, record
+
+# simulates every (lines, ways) configuration of the sweep grid in a single pass over the log.
+# pLRU runs one Cache per grid point in lockstep over each decoded batch;
+# true LRU runs one LRUStack per line count covering all of the ways at once.
+def sweep(filename, args):
+    linelen = args.addrlen - args.taglen - int(math.log(args.numlines, 2)) # offset bits, fixed across the sweep
+    def taglen(lines):
+        return args.addrlen - linelen - int(math.log(lines, 2))
+
+    # sampling the sets of the smallest geometry samples whole sets of every larger one,
+    # since they share its low set bits. each sampled set is a cluster of the estimate.
+    sampler = None
+    if args.sample_sets:
+        minlines = min(args.sweeplines)
+        if not 1 <= args.sample_sets <= minlines:
+            print(f"Error: --sample-sets must be between 1 and the smallest --sweeplines ({minlines})")
+            sys.exit(1)
+        sampler = setsampler(minlines, args.sample_sets, linelen)
+        clusterof = np.zeros(minlines, dtype=np.intp)
+        clusterof[sampler.sets] = np.arange(len(sampler.sets))
+        clusteraccesses = np.zeros(len(sampler.sets), dtype=np.int64)
+
+    if args.policy == 'plru':
+        models = [Cache(lines, ways, args.addrlen, taglen(lines)) for lines in args.sweeplines for ways in args.sweepways]
+        counts = [[0, 0, 0] for _ in models] # hits, misses, writebacks
+        clustermisses = [np.zeros(len(sampler.sets), dtype=np.int64) for _ in models] if sampler else None
+    else:
+        models = [LRUStack(lines, args.sweepways, args.addrlen, taglen(lines)) for lines in args.sweeplines]
+        clustermisses = [[np.zeros(len(sampler.sets), dtype=np.int64) for _ in args.sweepways] for _ in models] if sampler else None
+    quiet = argparse.Namespace(verbose=False)
+    stats = Stats()
+
+    for kind, record in decodedrecords(filename, sampler):
+        if kind == 'control':
+            for model in models:
+                control(model, record, quiet, stats)
+            continue
+        addrs, writes = record
+        if sampler:
+            clusters = clusterof[((addrs >> np.uint64(linelen)) & np.uint64(minlines - 1)).astype(np.intp)]
+            clusteraccesses += np.bincount(clusters, minlength=len(clusteraccesses))
+        for i, model in enumerate(models):
+            results = model.access_many(addrs, writes)
+            if args.policy == 'plru':
+                numhits = int(np.count_nonzero(results == 'H'))
+                counts[i][0] += numhits
+                counts[i][1] += len(results) - numhits
+                counts[i][2] += int(np.count_nonzero(results == 'D'))
+                if sampler:
+                    clustermisses[i] += np.bincount(clusters, weights=results != 'H', minlength=len(clusteraccesses)).astype(np.int64)
+            elif sampler:
+                for j, ways in enumerate(model.waylist):
+                    clustermisses[i][j] += np.bincount(clusters, weights=results >= ways, minlength=len(clusteraccesses)).astype(np.int64)
+
+    rows = [] # lines, ways, hits, misses, writebacks, and misses per sampled set
+    if args.policy == 'plru':
+        for i, (model, (hits, misses, writebacks)) in enumerate(zip(models, counts)):
+            rows.append((model.numsets, model.numways, hits, misses, writebacks, clustermisses and clustermisses[i]))
+    else:
+        for i, model in enumerate(models):
+            for j, ways in enumerate(model.waylist):
+                rows.append((model.numsets, ways, model.hits[j], model.misses[j], model.writebacks[j], clustermisses and clustermisses[i][j]))
+
+    if sampler:
+        # extrapolated to all sets
+        print(f"Sampled {len(sampler.sets)} of {minlines} sets of the {minlines}-line geometries; counts are estimates for all sets.")
+        print(f"{'lines':>8} {'ways':>5} {'hits':>12} {'misses':>12} {'writebacks':>12} {'missrate':>9} {'95% conf':>9}")
+        scale = minlines / len(sampler.sets)
+        for lines, ways, hits, misses, writebacks, missesbyset in rows:
+            rate, halfwidth = sampler.estimate(clusteraccesses, missesbyset)
+            print(f"{lines:>8} {ways:>5} {round(hits*scale):>12} {round(misses*scale):>12} {round(writebacks*scale):>12} "
+                  f"{100*rate:>8.3f}% {100*halfwidth:>8.3f}%")
+        return 0
+
+    print(f"{'lines':>8} {'ways':>5} {'hits':>12} {'misses':>12} {'writebacks':>12} {'missrate':>9}")
+    for lines, ways, hits, misses, writebacks, _ in rows:
+        missrate = 100*misses/(hits+misses) if hits+misses else 0
+        print(f"{lines:>8} {ways:>5} {hits:>12} {misses:>12} {writebacks:>12} {missrate:>8.3f}%")
+    return 0
+
+# simulates an L1 over its cycle-stamped log, yielding (cycle, addr, write, name) for every
+# line it reads from (a miss) or writes back to (a dirty eviction, flush, or cbo) the L2,
+# and (cycle, None, test, name) for the BEGIN/TRAIN record that starts each test
+def l1requests(cache, f, args, stats, name, filename):
+    cycle = 0 # markers aren't stamped, so they take the cycle of the record before them
+    for ln in f:
+        lninfo = ln.split()
+        if len(lninfo) >= 3:
+            if len(lninfo) < 4:
+                print(f"Error: {filename} has no cycle stamps; rerun the simulation with the current testbench loggers")
+                sys.exit(1)
+            cycle = int(lninfo[3])
+        if len(lninfo) < 3 or lninfo[1] in CONTROLOPS:
+            if lninfo[1:2] == ['F']:
+                for addr in cache.dirtyaddrs():
+                    yield cycle, addr, True, name
+            elif lninfo[1:2] in (['C'], ['L']) and cache.isdirtyaddr(int(lninfo[0], 16)):
+                yield cycle, int(lninfo[0], 16), True, name
+            control(cache, lninfo, args, stats)
+            if lninfo[:1] in (['BEGIN'], ['TRAIN']):
+                yield cycle, None, stats.test, name
+            continue
+
+        addr = int(lninfo[0], 16)
+        tag, setnum, _ = cache.splitaddr(addr)
+        result = cache.accessline(tag, setnum, lninfo[1] == 'W' or lninfo[1] == 'A' or lninfo[1] == 'Z')
+        tallyaccess(cache, args, stats, lninfo, addr, result)
+        if result == 'D':
+            yield cycle, cache.lineaddr(cache.victimtag, setnum), True, name
+        if result != 'H':
+            yield cycle, addr, False, name
+
+# simulates the I$ and D$ logs of one run and a shared L2 that serves their misses and
+# writebacks in cycle order. the L2 is emptied when either log starts a new test.
+def hierarchy(dfile, args):
+    ifile = os.path.expanduser(args.ifile) if args.ifile else dfile.replace('DCache', 'ICache')
+    if ifile == dfile or not os.path.exists(ifile):
+        print(f"Error: can't find the I$ log {ifile}; give it with --ifile")
+        sys.exit(1)
+    ilines, iways, itaglen = args.icache or (args.numlines, args.numways, args.taglen)
+    l2lines, l2ways, l2taglen = args.l2
+    icache = Cache(ilines, iways, args.addrlen, itaglen)
+    dcache = Cache(args.numlines, args.numways, args.addrlen, args.taglen)
+    l2 = Cache(l2lines, l2ways, args.addrlen, l2taglen)
+    istats, dstats = Stats(), Stats()
+    reads, writes, hits, misses = Counter(), Counter(), Counter(), Counter() # by L1 name
+    writebacks = 0 # from the L2 to memory
+    l2test = 0
+
+    with openlog(ifile) as fi, openlog(dfile) as fd:
+        requests = heapq.merge(l1requests(icache, fi, args, istats, 'I$', ifile),
+                               l1requests(dcache, fd, args, dstats, 'D$', dfile), key=operator.itemgetter(0))
+        for _, addr, write, name in requests:
+            if addr is None:
+                if write > l2test: # the other L1 may already have started this test
+                    l2.invalidate()
+                    l2.clear_pLRU()
+                    l2test = write
+                continue
+            result = l2.cacheaccess(addr, write)
+            (writes if write else reads)[name] += 1
+            (hits if result == 'H' else misses)[name] += 1
+            writebacks += result == 'D'
+
+    for name, stats in (('I$', istats), ('D$', dstats)):
+        print(f"{name}:")
+        stats.report(args)
+    accesses = sum(reads.values()) + sum(writes.values())
+    missrate = 100*sum(misses.values())/accesses if accesses else 0
+    print(f"L2 ({l2lines} lines, {l2ways} ways): {accesses} accesses, {sum(hits.values())} hits, "
+          f"{sum(misses.values())} misses ({missrate:.3f}%), {writebacks} writebacks to memory.")
+    for name in ('I$', 'D$'):
+        print(f"  from the {name}: {reads[name]} line reads and {writes[name]} writebacks, "
+              f"{hits[name]} hits and {misses[name]} misses.")
+    return istats.mismatches + dstats.mismatches
+
+# finds the byte range of every segment of the log. a segment starts at each
+# BEGIN/TRAIN record, which empties the cache, so segments are independent.
+def indexsegments(filename):
+    size = os.path.getsize(filename)
+    if size == 0:
+        return []
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        starts = [m.start() for m in re.finditer(rb'^[ \t]*(?:BEGIN|TRAIN)(?=\s|$)', mm, re.MULTILINE)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    return list(zip(starts, [*starts[1:], size]))
+
+# yields the lines of the log between two byte offsets that fall on line boundaries
+def readsegment(filename, start, end):
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(remaining, 1 << 24))
+            remaining -= len(chunk)
+            if remaining > 0 and not chunk.endswith(b'\n'):
+                tail = f.readline()
+                chunk += tail
+                remaining -= len(tail)
+            if not chunk:
+                break
+            yield from chunk.decode().splitlines()
+
+# simulates a text log or binary trace, or only one segment of it:
+# a byte range of a text log or a record range of a binary trace
+def simulate_file(cache, filename, args, stats, segment=None):
+    if isbinarytrace(filename):
+        trace = BinaryTrace(filename)
+        start, end = segment or (0, len(trace))
+        if args.reference:
+            simulate_reference(cache, trace.lines(start, end), args, stats)
+        else:
+            simulate_binary(cache, trace, args, stats, start, end)
+    else:
+        simulate = simulate_reference if args.reference else simulate_batched
+        if segment is None:
+            with openlog(filename) as f:
+                simulate(cache, f, args, stats)
+        else:
+            simulate(cache, readsegment(filename, *segment), args, stats)
+
+# simulates one segment in a fresh cache, capturing its printed output and
+# writing its mismatch detail to a temporary file next to the --mismatch-file.
+# test is the number of BEGIN/TRAIN records before the segment.
+def simulate_segment(filename, args, job):
+    test, segment = job
     cache = Cache(args.numlines, args.numways, args.addrlen, args.taglen)
+    stats = newstats(args)
+    stats.test = test
+    detailname = None
+    if args.mismatch_file:
+        stats.detail = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(args.mismatch_file)),
+                                                   delete=False, buffering=DETAILBUFFER)
+        detailname = stats.detail.name
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        simulate_file(cache, filename, args, stats, segment)
+    if stats.detail:
+        stats.detail.close()
+    return stats, output.getvalue(), detailname
+
+# simulates the segments of the log in a process pool, printing their output
+# and merging their counts and mismatch detail in the original order
+def simulate_parallel(filename, args, stats):
+    if isbinarytrace(filename):
+        segments = BinaryTrace(filename).segments()
+        firstline = next(BinaryTrace(filename).lines(*segments[0]), '') if segments else ''
+    else:
+        segments = indexsegments(filename)
+        firstline = next(readsegment(filename, *segments[0]), '') if segments else ''
+    # every segment but the first starts with a BEGIN/TRAIN record
+    firsttest = 0 if firstline.split()[:1] in (['BEGIN'], ['TRAIN']) else -1
+    jobs = [(max(0, firsttest + i), segment) for i, segment in enumerate(segments)]
+    with Pool(processes=args.jobs) as pool:
+        for segstats, output, detailname in pool.imap(partial(simulate_segment, filename, args), jobs):
+            sys.stdout.write(output)
+            stats.merge(segstats)
+            if detailname:
+                with open(detailname) as detail:
+                    shutil.copyfileobj(detail, stats.detail)
+                os.remove(detailname)
+
+# the number of bytes in a text log or records in a binary trace
+def filelength(filename):
+    return len(BinaryTrace(filename)) if isbinarytrace(filename) else os.path.getsize(filename)
+
+# saves the cache, counters, and input position (a byte offset in a text log
+# or record index in a binary trace) so the run can be resumed from there
+def savecheckpoint(args, cache, stats, filename, position):
+    if stats.detail:
+        stats.detail.flush()
+        stats.detailoffset = stats.detail.tell()
+    state = {'file': os.path.realpath(filename),
+             'geometry': (args.numlines, args.numways, args.addrlen, args.taglen),
+             'position': position, 'cache': cache, 'stats': stats}
+    tmpfile = args.checkpoint + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(tmpfile, args.checkpoint) # never leave a partially written checkpoint
+
+# loads the checkpoint saved by an earlier run over the same log and geometry
+def loadcheckpoint(args, filename):
+    with open(args.checkpoint, 'rb') as f:
+        state = pickle.load(f)
+    geometry = (args.numlines, args.numways, args.addrlen, args.taglen)
+    if state['file'] != os.path.realpath(filename) or state['geometry'] != geometry:
+        print(f"Error: checkpoint {args.checkpoint} is for {state['file']} with L W A T = {state['geometry']}")
+        sys.exit(1)
+    return state['cache'], state['stats'], state['position']
+
+# simulates a text log or binary trace from the given position,
+# saving a checkpoint after every args.checkpoint_every lines/records
+def simulate_checkpointed(cache, filename, args, stats, position):
+    every = args.checkpoint_every
+    sincecheckpoint = 0
+    if isbinarytrace(filename):
+        end = len(BinaryTrace(filename))
+        while position < end:
+            nextposition = min(end, position + min(every - sincecheckpoint, CHECKPOINTCHUNK))
+            simulate_file(cache, filename, args, stats, (position, nextposition))
+            sincecheckpoint += nextposition - position
+            position = nextposition
+            if sincecheckpoint >= every:
+                savecheckpoint(args, cache, stats, filename, position)
+                sincecheckpoint = 0
+    else:
+        simulate = simulate_reference if args.reference else simulate_batched
+        with open(filename, 'rb') as f:
+            f.seek(position)
+            while True:
+                lines = list(itertools.islice(f, min(every - sincecheckpoint, CHECKPOINTCHUNK)))
+                if not lines:
+                    break
+                simulate(cache, b''.join(lines).decode().splitlines(), args, stats)
+                sincecheckpoint += len(lines)
+                if sincecheckpoint >= every:
+                    savecheckpoint(args, cache, stats, filename, f.tell())
+                    sincecheckpoint = 0
+
+# simulates the log serially, in parallel segments, or with checkpoints
+def simulate_main(extfile, args, stats):
+    if args.checkpoint_every or args.resume:
+        if args.jobs > 1 or isfifo(extfile) or compressedopener(extfile) is not None:
+            print("Error: checkpoints need an uncompressed log file (not a pipe) and no -j")
+            sys.exit(1)
+        args.checkpoint = os.path.expanduser(args.checkpoint or f"{extfile}.ckpt")
+        cache = Cache(args.numlines, args.numways, args.addrlen, args.taglen)
+        position = 0
+        if args.resume:
+            cache, saved, position = loadcheckpoint(args, extfile)
+            if stats.detail:
+                stats.detail.truncate(saved.detailoffset) # drop the detail written after the checkpoint
+            saved.detail = stats.detail
+            stats.__dict__.update(saved.__dict__)
+        if args.checkpoint_every:
+            simulate_checkpointed(cache, extfile, args, stats, position)
+        else:
+            simulate_file(cache, extfile, args, stats, (position, filelength(extfile)))
+    elif args.jobs > 1 and not isfifo(extfile) and compressedopener(extfile) is None: # pipes and compressed logs can't be split into segments
+        simulate_parallel(extfile, args, stats)
+    else:
+        cache = Cache(args.numlines, args.numways, args.addrlen, args.taglen)
+        simulate_file(cache, extfile, args, stats)
+
+def main(args):
     extfile = os.path.expanduser(args.file)
-    mismatches = 0
-
-    if args.perf:
-        hits = 0
-        misses = 0
-
-    if args.dist:
-        loads = 0
-        stores = 0
-        atoms = 0
-        totalops = 0
-
-    with open(extfile) as f:
-        for ln in f:
-            ln = ln.strip()
-            lninfo = ln.split()
-            if len(lninfo) < 3: #non-address line
-                if len(lninfo) > 0 and (lninfo[0] == 'BEGIN' or lninfo[0] == 'TRAIN'):
-                    # currently BEGIN and END traces aren't being recorded correctly
-                    # trying TRAIN clears instead
-                    cache.invalidate() # a new test is starting, so 'empty' the cache
-                    cache.clear_pLRU()
-                    if args.verbose:
-                        print("New Test")
+    if args.tobinary:
+        with openlog(extfile) as f:
+            writebinary(f, os.path.expanduser(args.tobinary))
+        return 0
+    if args.sweep:
+        return sweep(extfile, args)
+    if args.l2:
+        if args.jobs > 1 or args.sample_sets or args.checkpoint_every or args.resume or isbinarytrace(extfile):
+            print("Error: --l2 simulates cycle-stamped text logs serially, without -j, --sample-sets, or checkpoints")
+            sys.exit(1)
+        return hierarchy(extfile, args)
 
-            else:
-                if args.dist:
-                    totalops += 1
-
-                if lninfo[1] == 'F':
-                    cache.flush()
-                    if args.verbose:
-                        print("F")
-                elif lninfo[1] == 'I':
-                    cache.invalidate()
-                    if args.verbose:
-                        print("I")
-                elif lninfo[1] == 'V' or lninfo[1] == 'L' or lninfo[1] == 'C':
-                    addr = int(lninfo[0], 16)
-                    IsCBOClean = lninfo[1] != 'C'
-                    cache.cbo(addr, IsCBOClean)
-                    if args.verbose:
-                        print(lninfo[1])
-                else:
-                    addr = int(lninfo[0], 16)
-                    iswrite = lninfo[1] == 'W' or lninfo[1] == 'A' or lninfo[1] == 'Z'
-                    result = cache.cacheaccess(addr, iswrite)
-
-                    if args.verbose:
-                        tag, setnum, offset = cache.splitaddr(addr)
-                        print(hex(addr), hex(tag), hex(setnum), hex(offset), lninfo[2], result)
-
-                    if args.perf:
-                        if result == 'H':
-                            hits += 1
-                        else:
-                            misses += 1
-
-                    if args.dist:
-                        if lninfo[1] == 'R':
-                            loads += 1
-                        elif lninfo[1] == 'W':
-                            stores += 1
-                        elif lninfo[1] == 'A':
-                            atoms += 1
-
-                    if result != lninfo[2]:
-                        print(f"Result mismatch at address {lninfo[0]}. Wally: {lninfo[2]}, Sim: {result}")
-                        mismatches += 1
-    if args.dist:
-        percent_loads = str(round(100*loads/totalops))
-        percent_stores = str(round(100*stores/totalops))
-        percent_atoms = str(round(100*atoms/totalops))
-        print(f"This log had {percent_loads}% loads, {percent_stores}% stores, and {percent_atoms}% atomic operations.")
-
-    if args.perf:
-        ratio = round(hits/misses,3)
-        print("There were", hits, "hits and", misses, "misses. The hit/miss ratio was", str(ratio)+".")
-
-    if mismatches == 0:
-        print("SUCCESS! There were no mismatches between Wally and the sim.")
-    return mismatches
+    if args.sample_sets is not None and not 1 <= args.sample_sets <= args.numlines:
+        print(f"Error: --sample-sets must be between 1 and the number of lines ({args.numlines})")
+        sys.exit(1)
+    if args.classify and args.sample_sets:
+        print("Error: --classify needs every set simulated, so it can't be used with --sample-sets")
+        sys.exit(1)
+    stats = newstats(args)
+    detail = open(args.mismatch_file, 'a', buffering=DETAILBUFFER) if args.mismatch_file else contextlib.nullcontext()
+    with detail:
+        if args.mismatch_file:
+            if not args.resume:
+                detail.truncate(0)
+            stats.detail = detail
+        simulate_main(extfile, args, stats)
+    stats.report(args)
+    if args.histogram:
+        writehistogram(os.path.expanduser(args.histogram), stats)
+    return stats.mismatches
 
 if __name__ == '__main__':
     args = parseArgs()
@@ -0,0 +1,259 @@
+#!/usr/bin/env -S uv run --script
+
+###########################################
+## CacheSimBench.py
+##
+## Created: 18 October 2026
+##
+## Purpose: Generate synthetic I$/D$ logs and measure CacheSim.py's throughput
+##
+## A component of the CORE-V-WALLY configurable RISC-V project.
+## https://github.com/openhwgroup/cvw
+##
+## Copyright (C) 2021-26 Harvey Mudd College & Oklahoma State University
+##
+## SPDX-License-Identifier: Apache-2.0 WITH SHL-2.1
+##
+## Licensed under the Solderpad Hardware License v 2.1 (the “License”); you may not use this file
+## except in compliance with the License, or, at your option, the Apache License version 2.0. You
+## may obtain a copy of the License at
+##
+## https:##solderpad.org/licenses/SHL-2.1/
+##
+## Unless required by applicable law or agreed to in writing, any work distributed under the
+## License is distributed on an “AS IS” BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+## either express or implied. See the License for the specific language governing permissions
+## and limitations under the License.
+################################################################################################
+
+# how to use this benchmark:
+# CacheSimBench.py generate <pattern> -n <records> -o <log file>
+#   writes a reproducible synthetic log in the format of the I$/D$ loggers in testbench/common/loggers.sv,
+#   with the Wally results filled in by CacheSim's own model so the log simulates without mismatches.
+#   The patterns are ifetch (an I$ log) and stream, strided, random, pointerchase, and cbo (D$ logs).
+# CacheSimBench.py run [-n <records>] [--patterns ...] [--save <baseline>] [--compare <baseline>]
+#   generates each pattern (kept in --dir if given) and reports CacheSim's throughput in accesses per second:
+#   parse (reading and decoding the log), sim (only the cache model), and total (a whole CacheSim.py -p run).
+#   --save stores the results as a JSON baseline; --compare prints the speedup over a baseline and exits
+#   with 1 if any rate dropped by more than --tolerance.
+# e.g. 'CacheSimBench.py run -n 1000000 --save base.json', then after a change 'CacheSimBench.py run -n 1000000 --compare base.json'
+
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import CacheSim
+import numpy as np
+
+PATTERNS = ('ifetch', 'stream', 'strided', 'random', 'pointerchase', 'cbo')
+# records generated, simulated for their results, and written at a time
+CHUNK = 1 << 18
+BASE = 0x80000000 # start of Wally's RAM
+
+# returns the addresses and ops of records start to start+count of a pattern.
+# every pattern is a function of the record index and the seeded state alone,
+# so a log is the same whatever the chunking.
+def pattern_records(pattern, state, start, count):
+    rng = np.random.default_rng([state['seed'], start])
+    index = np.arange(start, start + count, dtype=np.uint64)
+    if pattern == 'ifetch':
+        # basic blocks of 1-16 sequential instructions within a 64 KiB program
+        # each group of 16 fetches loops over one block
+        block = (index // np.uint64(16)) % np.uint64(len(state['blockstarts']))
+        addrs = BASE + state['blockstarts'][block] + np.uint64(4) * (index % np.uint64(16) % state['blocklens'][block])
+        ops = np.full(count, 'R')
+        ops[rng.random(count) < 0.0001] = 'I' # fence.i
+        return addrs, ops
+    if pattern == 'stream':
+        addrs = BASE + (np.uint64(8) * index) % np.uint64(64 << 20)
+        ops = np.where(rng.random(count) < 0.3, 'W', 'R')
+    elif pattern == 'strided':
+        addrs = BASE + (np.uint64(4160) * index) % np.uint64(16 << 20)
+        ops = np.where(rng.random(count) < 0.2, 'W', 'R')
+    elif pattern == 'random':
+        addrs = BASE + np.uint64(8) * rng.integers(0, (1 << 20) // 8, count, dtype=np.uint64)
+        ops = np.where(rng.random(count) < 0.3, 'W', 'R')
+    elif pattern == 'pointerchase':
+        # one cycle through 16384 64-byte nodes in a random order
+        addrs = BASE + np.uint64(64) * state['chain'][index % np.uint64(len(state['chain']))]
+        ops = np.full(count, 'R')
+    else: # cbo
+        addrs = BASE + np.uint64(8) * rng.integers(0, (64 << 10) // 8, count, dtype=np.uint64)
+        ops = rng.choice(np.array(['R', 'W', 'A', 'Z', 'V', 'C', 'L', 'F']), count, p=[0.5, 0.2, 0.05, 0.05, 0.06, 0.06, 0.06, 0.02])
+    return addrs, ops
+
+# the per-log state of the patterns that need it
+def pattern_state(pattern, seed):
+    rng = np.random.default_rng(seed)
+    state = {'seed': seed}
+    if pattern == 'ifetch':
+        state['blockstarts'] = np.uint64(64) * rng.integers(0, (64 << 10) // 64, 4096, dtype=np.uint64)
+        state['blocklens'] = rng.integers(1, 17, 4096, dtype=np.uint64)
+    elif pattern == 'pointerchase':
+        state['chain'] = rng.permutation(16384).astype(np.uint64)
+    return state
+
+# writes a synthetic log of the pattern with the given number of records (besides
+# the BEGIN markers that split it into tests), in the loggers' exact format
+def generate(pattern, numrecords, outname, geometry, seed=0, tests=4):
+    numlines, numways, addrlen, taglen = geometry
+    digits = math.ceil(addrlen / 4)
+    cache = CacheSim.Cache(numlines, numways, addrlen, taglen)
+    quiet = argparse.Namespace(verbose=False)
+    stats = CacheSim.Stats()
+    state = pattern_state(pattern, seed)
+    cycle = 0
+    testlen = -(-numrecords // tests)
+    with open(outname, 'w', buffering=1 << 20) as out:
+        for start in range(0, numrecords, CHUNK):
+            count = min(CHUNK, numrecords - start)
+            addrs, ops = pattern_records(pattern, state, start, count)
+            results = np.full(count, 'X')
+            cycles = cycle + np.cumsum(np.random.default_rng([seed, start, 1]).integers(1, 5, count))
+            cycle = int(cycles[-1])
+            # tests start every testlen records; controls and test starts split the accesses into runs
+            teststarts = np.arange(-start % testlen, count, testlen)
+            breaks = np.union1d(np.flatnonzero(np.isin(ops, CacheSim.CONTROLOPS)), teststarts).tolist()
+            prev = 0
+            for index in [*breaks, count]:
+                if prev < index:
+                    run = slice(prev, index)
+                    results[run] = cache.access_many(addrs[run], np.isin(ops[run], ('W', 'A', 'Z')))
+                if index == count:
+                    break
+                if index in teststarts:
+                    CacheSim.control(cache, ['BEGIN', f"{pattern}{(start + index) // testlen}"], quiet, stats)
+                if ops[index] in CacheSim.CONTROLOPS:
+                    CacheSim.control(cache, [f"{int(addrs[index]):x}", str(ops[index]), 'X'], quiet, stats)
+                    results[index] = 'X' if ops[index] in ('F', 'I') else 'H'
+                    prev = index + 1
+                else:
+                    prev = index
+
+            teststarts = set(teststarts.tolist())
+            lines = []
+            for i, (addr, op, result, stamp) in enumerate(zip(addrs.tolist(), ops.tolist(), results.tolist(), cycles.tolist())):
+                if i in teststarts:
+                    lines.append(f"BEGIN {pattern}{(start + i) // testlen}\n")
+                if op == 'F' or op == 'I':
+                    lines.append(f"0 {op} X {stamp}\n")
+                else:
+                    lines.append(f"{addr:0{digits}x} {op} {result} {stamp}\n")
+            out.write(''.join(lines))
+        out.write(f"END {pattern}\n")
+
+# times decoding the log into batches without simulating them
+def time_parse(filename):
+    start = time.perf_counter()
+    accesses = 0
+    for kind, record in CacheSim.decodedrecords(filename):
+        if kind == 'access':
+            accesses += len(record[0])
+    return accesses, time.perf_counter() - start
+
+# times only the cache model over the decoded log
+def time_sim(filename, geometry):
+    cache = CacheSim.Cache(*geometry)
+    quiet = argparse.Namespace(verbose=False)
+    stats = CacheSim.Stats()
+    elapsed = 0.0
+    for kind, record in CacheSim.decodedrecords(filename):
+        start = time.perf_counter()
+        if kind == 'access':
+            cache.access_many(*record)
+        else:
+            CacheSim.control(cache, record, quiet, stats)
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+# times a whole CacheSim.py run, checking that the log simulates without mismatches
+def time_total(filename, geometry):
+    cachesim = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'CacheSim.py')
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, cachesim, *map(str, geometry), '-f', filename, '-p'], capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        print(f"Error: CacheSim.py reported mismatches on {filename}:\n{result.stdout}")
+        sys.exit(1)
+    return elapsed
+
+def run(args):
+    geometry = tuple(args.geometry)
+    logdir = args.dir or tempfile.mkdtemp(prefix='CacheSimBench')
+    os.makedirs(logdir, exist_ok=True)
+    results = {}
+    print(f"{'pattern':>12} {'records':>10} {'parse acc/s':>12} {'sim acc/s':>12} {'total acc/s':>12}")
+    for pattern in args.patterns:
+        kind = 'ICache' if pattern == 'ifetch' else 'DCache'
+        logname = os.path.join(logdir, f"{pattern}_{args.records}_{args.seed}_{kind}.log")
+        if not os.path.exists(logname):
+            generate(pattern, args.records, logname, geometry, args.seed, args.tests)
+        # the best of the repeats is the least disturbed by the rest of the machine
+        accesses, parsetime = min(time_parse(logname) for _ in range(args.repeat))
+        simtime = min(time_sim(logname, geometry) for _ in range(args.repeat))
+        totaltime = min(time_total(logname, geometry) for _ in range(args.repeat))
+        if not args.dir:
+            os.remove(logname)
+        rates = {'parse': accesses/parsetime, 'sim': accesses/simtime, 'total': accesses/totaltime}
+        results[pattern] = {'records': args.records, 'accesses': accesses, **rates}
+        print(f"{pattern:>12} {args.records:>10} {rates['parse']:>12.0f} {rates['sim']:>12.0f} {rates['total']:>12.0f}")
+    if not args.dir:
+        os.rmdir(logdir)
+
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print(f"\nSpeedup over {args.compare}:")
+        print(f"{'pattern':>12} {'parse':>8} {'sim':>8} {'total':>8}")
+        for pattern, rates in results.items():
+            base = baseline.get(pattern)
+            if base is None or base['records'] != rates['records']:
+                print(f"{pattern:>12} no baseline with {rates['records']} records")
+                continue
+            speedups = {key: rates[key] / base[key] for key in ('parse', 'sim', 'total')}
+            slower = [key for key, speedup in speedups.items() if speedup < 1 - args.tolerance/100]
+            print(f"{pattern:>12} {speedups['parse']:>7.2f}x {speedups['sim']:>7.2f}x {speedups['total']:>7.2f}x" +
+                  (f"  slower: {', '.join(slower)}" if slower else ""))
+            status |= bool(slower)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'geometry': geometry, 'seed': args.seed, 'python': platform.python_version(),
+                       'numpy': np.__version__, 'machine': platform.machine(), 'date': time.strftime('%Y-%m-%d'),
+                       'results': results}, f, indent=2)
+    return status
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Generates synthetic cache logs and benchmarks CacheSim.py.")
+    parser.add_argument('--geometry', type=int, nargs=4, default=[64, 4, 56, 44], metavar=('L', 'W', 'A', 'T'), help="Cache geometry for the results and the runs (default: rv64gc's 64 4 56 44)")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic logs")
+    parser.add_argument('--tests', type=int, default=4, help="Number of BEGIN records the log is split into")
+    commands = parser.add_subparsers(dest='command', required=True)
+    gen = commands.add_parser('generate', help="Write one synthetic log")
+    gen.add_argument('pattern', choices=PATTERNS)
+    gen.add_argument('-n', '--records', type=int, default=100000, help="Number of log records")
+    gen.add_argument('-o', '--output', required=True, help="Log file to write")
+    bench = commands.add_parser('run', help="Benchmark CacheSim.py on every pattern")
+    bench.add_argument('-n', '--records', type=int, default=100000, help="Number of log records per pattern (1e5 to 1e8)")
+    bench.add_argument('--patterns', nargs='+', choices=PATTERNS, default=list(PATTERNS))
+    bench.add_argument('--repeat', type=int, default=3, help="Time each measurement this many times and keep the fastest (default 3)")
+    bench.add_argument('--dir', help="Keep the generated logs in this directory and reuse them on later runs")
+    bench.add_argument('--save', metavar='BASELINE', help="Store the results as a JSON baseline")
+    bench.add_argument('--compare', metavar='BASELINE', help="Report the speedup over a stored baseline")
+    bench.add_argument('--tolerance', type=float, default=10, help="Percent slowdown from the baseline that counts as a regression (default 10)")
+    return parser.parse_args()
+
+def main(args):
+    if args.command == 'generate':
+        generate(args.pattern, args.records, args.output, tuple(args.geometry), args.seed, args.tests)
+        return 0
+    return run(args)
+
+if __name__ == '__main__':
+    sys.exit(main(parseArgs()))
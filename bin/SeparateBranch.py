@@ -0,0 +1,261 @@
+#!/usr/bin/env -S uv run --script
+
+###########################################
+## SeparateBranch.py
+##
+## Created: 18 October 2026
+##
+## Purpose: Converts a single branch.log containing multiple benchmark branch outcomes into
+##          separate files, one for each program, in a single pass over the log.
+## Input:   branch log file (branch.log or cfi.log) generated by the BPRED_LOGGER
+## output:  outputs to directory branch a collection of files with the branch outcomes
+##          separated by benchmark application.  Example names are aha-mot64bd_sizeopt_speed_branch.log
+##          and a sidecar index branch.log.index.json with each benchmark's byte offsets in the log
+##
+## A component of the CORE-V-WALLY configurable RISC-V project.
+## https://github.com/openhwgroup/cvw
+##
+## Copyright (C) 2021-26 Harvey Mudd College & Oklahoma State University
+##
+## SPDX-License-Identifier: Apache-2.0 WITH SHL-2.1
+##
+## Licensed under the Solderpad Hardware License v 2.1 (the “License”); you may not use this file
+## except in compliance with the License, or, at your option, the Apache License version 2.0. You
+## may obtain a copy of the License at
+##
+## https:##solderpad.org/licenses/SHL-2.1/
+##
+## Unless required by applicable law or agreed to in writing, any work distributed under the
+## License is distributed on an “AS IS” BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+## either express or implied. See the License for the specific language governing permissions
+## and limitations under the License.
+################################################################################################
+
+# how to invoke:
+# SeparateBranch.py branch.log [-o outdir] [--index-only]
+# Each benchmark's file holds the lines after its TRAIN up to its END, as SeparateBranch.sh wrote
+# them: the BEGIN line, the training outcomes and the sampled outcomes. The benchmark name comes
+# from the memfile on the BEGIN line. The log is read once in large blocks, and each benchmark's
+# file is written by its own writer thread while the reader moves on.
+# The index lists every benchmark's name, output file, and the byte offsets of its TRAIN, BEGIN and
+# END lines in the log (null when missing), along with the log's size and mtime so a stale index can
+# be detected. A tool can seek to a benchmark's offset instead of rescanning the log; readindex()
+# returns the index when it is still current.
+
+import argparse
+import contextlib
+import json
+import os
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCKSIZE = 1 << 24 # bytes read from the log at a time
+PENDINGBLOCKS = 8 # writes queued across all outputs before the reader waits for the writers
+MARKER = re.compile(rb'^(TRAIN|BEGIN|END)\b[^\n]*\n', re.MULTILINE)
+
+# the benchmark name of a BEGIN line's memfile, e.g. ../../addins/embench-iot/bd_sizeopt_speed/src/aha-mot64bd/...
+# gives aha-mot64bd_sizeopt_speed; other tests are named by their memfile's directory
+def benchmarkname(memfile):
+    parts = memfile.split('/')
+    if 'src' in parts[1:-2]:
+        src = parts.index('src', 1)
+        build = parts[src - 1]
+        return f"{parts[src + 1]}_{build.removeprefix('bd_')}"
+    return parts[-2] if len(parts) > 1 else parts[0].split('.')[0]
+
+def indexname(logname):
+    return logname + '.index.json'
+
+# the index of a log written by split(), or None if there is none or the log has changed since
+def readindex(logname):
+    try:
+        with open(indexname(logname)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    info = os.stat(logname)
+    if index.get('size') != info.st_size or index.get('mtime') != info.st_mtime_ns:
+        return None
+    return index
+
+# one benchmark's output file: written in order by a single-threaded executor, under a temporary
+# name until the benchmark ends so a crashed split leaves no truncated file behind. after a write
+# fails (e.g. the disk is full) the rest are skipped, the temporary file is removed instead of
+# renamed, and wait() raises the error.
+class Output:
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        self.tmppath = path + '.tmp'
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.file = None
+        self.failed = None # the first error of the writer thread
+        self.futures = []
+        self.submit(self.open)
+
+    def submit(self, task, *args):
+        future = self.executor.submit(self.run, task, *args)
+        self.futures.append(future)
+        return future
+
+    # runs a task on the writer thread unless an earlier one failed
+    def run(self, task, *args):
+        if self.failed is None:
+            try:
+                task(*args)
+            except OSError as err:
+                self.failed = err
+                raise
+
+    def open(self):
+        self.file = open(self.tmppath, 'wb', buffering=1 << 20)
+
+    def write(self, data):
+        if data:
+            self.slots.acquire()
+            self.submit(self.file_write, data).add_done_callback(lambda _: self.slots.release())
+
+    def file_write(self, data):
+        self.file.write(data)
+
+    def finish(self):
+        self.executor.submit(self.close)
+        self.executor.shutdown(wait=False)
+
+    def close(self):
+        try:
+            if self.file:
+                self.file.close()
+            if self.failed is None:
+                os.replace(self.tmppath, self.path)
+        except OSError as err:
+            self.failed = self.failed or err
+        if self.failed is not None:
+            with contextlib.suppress(OSError):
+                os.remove(self.tmppath)
+
+    def wait(self):
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+        if self.failed is not None:
+            raise self.failed
+
+# splits the log into outdir, one file per benchmark, and returns the index
+def split(logname, outdir, write=True):
+    base = os.path.basename(logname)
+    info = os.stat(logname)
+    benchmarks = []
+    outputs = []
+    names = set()
+    slots = threading.BoundedSemaphore(PENDINGBLOCKS)
+    current = None  # the benchmark being read: its index entry and Output
+    output = None
+    offset = 0      # offset of block in the log
+    pending = b''   # a partial line carried over to the next block
+    if write:
+        os.makedirs(outdir, exist_ok=True)
+
+    # starts a benchmark whose TRAIN line is at offset train; its name is known only at BEGIN
+    def start(train):
+        nonlocal current, output
+        current = {'name': None, 'file': None, 'train': train, 'begin': None, 'end': None}
+        benchmarks.append(current)
+        if write:
+            output = Output(os.path.join(outdir, f".{len(benchmarks)}_{base}"), slots)
+            outputs.append(output)
+
+    # ends the current benchmark, naming its file
+    def end():
+        nonlocal current, output
+        name = current['name'] or f"benchmark{len(benchmarks)}"
+        unique, n = name, 1
+        while unique in names: # a benchmark run twice gets a numbered second file
+            n += 1
+            unique = f"{name}-{n}"
+        names.add(unique)
+        current['name'] = unique
+        current['file'] = os.path.join(outdir, f"{unique}_{base}")
+        if output:
+            output.path = current['file']
+            output.finish()
+        current, output = None, None
+
+    with open(logname, 'rb', buffering=0) as f:
+        while True:
+            data = f.read(BLOCKSIZE)
+            if not data:
+                break
+            cut = data.rfind(b'\n') + 1
+            if cut == 0: # no complete line yet
+                pending += data
+                continue
+            block = pending + data[:cut]
+            blockoffset = offset
+            offset += len(block)
+            pending = data[cut:]
+            position = 0 # start of the block's lines not yet written or skipped
+            for marker in MARKER.finditer(block):
+                kind = marker.group(1)
+                if current and output:
+                    output.write(block[position:marker.start()])
+                position = marker.start()
+                if kind == b'TRAIN':
+                    if current:
+                        end()
+                    start(blockoffset + marker.start())
+                    position = marker.end()
+                elif kind == b'BEGIN':
+                    if not current or current['begin'] is not None:
+                        if current:
+                            end()
+                        start(None)
+                    current['begin'] = blockoffset + marker.start()
+                    current['name'] = benchmarkname(marker.group(0)[len('BEGIN'):].strip().decode())
+                elif current: # END
+                    current['end'] = blockoffset + marker.start()
+                    end()
+                    position = marker.end()
+            if current and output:
+                output.write(block[position:])
+        if pending and current and output: # a log cut off mid-line
+            output.write(pending)
+    if current:
+        print(f"Warning: {current['name'] or 'the last benchmark'} has no END; the log may be truncated", file=sys.stderr)
+        end()
+    failed = None
+    for output in outputs:
+        try:
+            output.wait()
+        except OSError as err:
+            failed = failed or err
+    if failed is not None:
+        raise failed
+
+    index = {'log': os.path.abspath(logname), 'size': info.st_size, 'mtime': info.st_mtime_ns, 'benchmarks': benchmarks}
+    with open(indexname(logname), 'w') as f:
+        json.dump(index, f, indent=2)
+    return index
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Splits a BPRED_LOGGER branch log into one file per benchmark.")
+    parser.add_argument('log', help="branch.log or cfi.log to split")
+    parser.add_argument('-o', '--outdir', help="Directory for the per-benchmark files (default: the log's name without extension)")
+    parser.add_argument('--index-only', action='store_true', help="Only write the offset index, not the per-benchmark files")
+    return parser.parse_args()
+
+def main(args):
+    outdir = args.outdir or os.path.basename(args.log).split('.')[0]
+    try:
+        index = split(args.log, outdir, write=not args.index_only)
+    except OSError as err:
+        print(f"Error: {err}", file=sys.stderr)
+        return 1
+    for benchmark in index['benchmarks']:
+        print(benchmark['name'], benchmark['train'], benchmark['begin'], benchmark['end'])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(parseArgs()))
@@ -0,0 +1,87 @@
+###########################################
+## compressedlog.py
+##
+## Created: 18 October 2026
+##
+## Purpose: Opens gzip or xz compressed logs as text, decompressing them in a background thread.
+##          Shared by CacheSim.py and parseHPMC.py.
+##
+## A component of the CORE-V-WALLY configurable RISC-V project.
+## https://github.com/openhwgroup/cvw
+##
+## Copyright (C) 2021-26 Harvey Mudd College & Oklahoma State University
+##
+## SPDX-License-Identifier: Apache-2.0 WITH SHL-2.1
+##
+## Licensed under the Solderpad Hardware License v 2.1 (the “License”); you may not use this file
+## except in compliance with the License, or, at your option, the Apache License version 2.0. You
+## may obtain a copy of the License at
+##
+## https:##solderpad.org/licenses/SHL-2.1/
+##
+## Unless required by applicable law or agreed to in writing, any work distributed under the
+## License is distributed on an “AS IS” BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+## either express or implied. See the License for the specific language governing permissions
+## and limitations under the License.
+################################################################################################
+
+import gzip
+import io
+import lzma
+import queue
+import threading
+
+# magic numbers of the compressed log formats that are decompressed on the fly
+COMPRESSED = {b'\x1f\x8b': gzip.open, b'\xfd7zXZ\x00': lzma.open}
+
+# a raw stream of the decompressed bytes of a compressed log. a background thread
+# decompresses ahead into a bounded queue so decompression overlaps parsing.
+class DecompressingReader(io.RawIOBase):
+    def __init__(self, filename, opener):
+        self.chunks = queue.Queue(maxsize=16)
+        self.pending = memoryview(b'')
+        self.done = False
+        threading.Thread(target=self.decompress, args=(filename, opener), daemon=True).start()
+
+    def decompress(self, filename, opener):
+        try:
+            with opener(filename, 'rb') as f:
+                while True:
+                    chunk = f.read(1 << 20)
+                    self.chunks.put(chunk)
+                    if not chunk:
+                        break
+        except (OSError, EOFError, lzma.LZMAError) as err:
+            self.chunks.put(err)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.pending and not self.done:
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            self.done = not chunk
+            self.pending = memoryview(chunk)
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+# returns the decompressor for a .gz or .xz file, or None for anything else.
+# reads the start of the file, so it must not be given a named pipe.
+def compressedopener(filename):
+    with open(filename, 'rb') as f:
+        magic = f.read(6)
+    for prefix, opener in COMPRESSED.items():
+        if magic.startswith(prefix):
+            return opener
+    return None
+
+# opens a text log, decompressing it in a background thread if it is compressed
+def openlog(filename):
+    opener = compressedopener(filename)
+    if opener is None:
+        return open(filename)
+    return io.TextIOWrapper(io.BufferedReader(DecompressingReader(filename, opener), buffer_size=1 << 20))
@@ -27,14 +27,21 @@
 ################################################################################################
 
 import argparse
+import hashlib
 import math
 import os
+import pickle
+import sqlite3
+import subprocess
 import sys
+from datetime import datetime
+from multiprocessing import Pool
 
-import matplotlib.pyplot as plt
+import compressedlog
 import numpy as np
 
 WALLY = os.environ.get('WALLY')
+args = None # the parsed command line, set by main()
 
 RefDataBP = [('twobitCModel6', 'twobitCModel', 64, 128, 10.0060297551637), ('twobitCModel8', 'twobitCModel', 256, 512, 8.4320392215602), ('twobitCModel10', 'twobitCModel', 1024, 2048, 7.29493318805151),
            ('twobitCModel12', 'twobitCModel', 4096, 8192, 6.84739616147794), ('twobitCModel14', 'twobitCModel', 16384, 32768, 5.68432926870082), ('twobitCModel16', 'twobitCModel', 65536, 131072, 5.68432926870082),
@@ -43,6 +50,20 @@ RefDataBP = [('twobitCModel6', 'twobitCModel', 64, 128, 10.0060297551637), ('two
 RefDataBTB = [('BTBCModel6', 'BTBCModel', 64, 128, 1.51480272475844), ('BTBCModel8', 'BTBCModel', 256, 512, 0.209057900418965), ('BTBCModel10', 'BTBCModel', 1024, 2048, 0.0117345454469572),
               ('BTBCModel12', 'BTBCModel', 4096, 8192, 0.00125540990359826), ('BTBCModel14', 'BTBCModel', 16384, 32768, 0.000732471628510962), ('BTBCModel16', 'BTBCModel', 65536, 131072, 0.000732471628510962)]
 
+# parsed transcripts are cached here, keyed by path, size and mtime
+CACHEDIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'wally', 'parseHPMC')
+CACHEVERSION = 1 # bump when ProcessFile's output changes
+
+# a counter database from --ingest can be given in place of the sources list file
+SQLITEMAGIC = b'SQLite format 3\x00'
+DBSCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, log TEXT, size INTEGER, mtime INTEGER, config TEXT, type TEXT,
+                                 params TEXT, simulator TEXT, rev TEXT, date TEXT, UNIQUE (log, size, mtime));
+CREATE TABLE IF NOT EXISTS counters (run INTEGER REFERENCES runs (id), benchmark TEXT, opt TEXT, name TEXT, value INTEGER);
+CREATE INDEX IF NOT EXISTS counterrun ON counters (run);
+CREATE INDEX IF NOT EXISTS runselect ON runs (simulator, config, date);
+'''
+
 def ParseBranchListFile(path):
     '''Take the path to the list of Questa Sim log files containing the performance counters outputs.  File
     is formatted in row columns.  Each row is a trace with the file, branch predictor type, and the parameters.
@@ -58,7 +79,7 @@ def ParseBranchListFile(path):
             #print(predictorLog, predictorType, predictorParams)
     return lst
 
-def ProcessFile(fileName):
+def ProcessFile(fileName, sim):
     '''Extract performance counters from a modelsim log.  Outputs a list of tuples for each test/benchmark.
     The tuple contains the test name, optimization characteristics, and dictionary of performance counters.'''
     # 1 find lines with Read memfile and extract test name
@@ -67,10 +88,13 @@ def ProcessFile(fileName):
     HPMClist = { }
     testName = ''
     opt = ''
-    with open(fileName) as transcript:
-        for line in transcript.readlines():
+    with compressedlog.openlog(fileName) as transcript:
+        for line in transcript:
+            # most of a transcript is other output; skip it before paying for split()
+            if 'Cnt' not in line and 'memfile' not in line and 'is done' not in line:
+                continue
             lineToken = line.split()
-            if (args.sim == "questa") & (lineToken[0] == "#"):
+            if (sim == "questa") & (lineToken[0] == "#"):
                 lineToken = lineToken[1:] # Questa uses a leading # for each line, other simulators do not
             if(len(lineToken) > 2 and lineToken[0] == 'Read' and lineToken[1] == 'memfile'):
                 opt = lineToken[2].split('/')[-4]
@@ -85,44 +109,185 @@ def ProcessFile(fileName):
                 benchmarks.append((testName, opt, HPMClist))
     return benchmarks
 
-
-def ComputeStats(benchmarks):
-    for benchmark in benchmarks:
-        (nameString, opt, dataDict) = benchmark
-        dataDict['CPI'] = 1.0 * int(dataDict['Mcycle']) / int(dataDict['InstRet'])
-        dataDict['BDMR'] = 100.0 * int(dataDict['BP Dir Wrong']) / int(dataDict['Br Count'])
-        dataDict['BTMR'] = 100.0 * int(dataDict['BP Target Wrong']) / (int(dataDict['Br Count']) + int(dataDict['Jump Not Return']))
-        dataDict['RASMPR'] = 100.0 * int(dataDict['RAS Wrong']) / int(dataDict['Return'])
-        dataDict['ClassMPR'] = 100.0 * int(dataDict['Instr Class Wrong']) / int(dataDict['InstRet'])
-        dataDict['ICacheMR'] = 100.0 * int(dataDict['I Cache Miss']) / int(dataDict['I Cache Access'])
-
-        cycles = int(dataDict['I Cache Miss'])
-        if(cycles == 0): ICacheMR = 0
-        else: ICacheMR = 100.0 * int(dataDict['I Cache Cycles']) / cycles
-        dataDict['ICacheMT'] = ICacheMR
-
-        dataDict['DCacheMR'] = 100.0 * int(dataDict['D Cache Miss']) / int(dataDict['D Cache Access'])
-
-        (nameString, opt, dataDict) = benchmark
-        cycles = int(dataDict['D Cache Miss'])
-        if(cycles == 0): DCacheMR = 0
-        else: DCacheMR = 100.0 * int(dataDict['D Cache Cycles']) / cycles
-        dataDict['DCacheMT'] = DCacheMR
-
-
-def ComputeGeometricAverage(benchmarks):
+def CacheFileName(fileName, sim):
+    '''The cache file of a transcript, named by a hash of its absolute path and the simulator.'''
+    key = f'{os.path.abspath(fileName)} {sim}'.encode()
+    return os.path.join(CACHEDIR, hashlib.sha256(key).hexdigest()[:32] + '.pickle')
+
+def CacheKey(fileName, sim):
+    '''What a cached parse must match to be reused: the transcript's path, size and mtime.'''
+    info = os.stat(fileName)
+    return (CACHEVERSION, os.path.abspath(fileName), sim, info.st_size, info.st_mtime_ns)
+
+def ReadCache(fileName, sim):
+    '''Return the cached ProcessFile output for a transcript, or None if it is missing or stale.'''
+    try:
+        with open(CacheFileName(fileName, sim), 'rb') as cache:
+            (key, benchmarks) = pickle.load(cache)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError, TypeError):
+        return None
+    return benchmarks if key == CacheKey(fileName, sim) else None
+
+def WriteCache(fileName, sim, key, benchmarks):
+    '''Save a transcript's ProcessFile output.  The file is replaced atomically so concurrent runs never read
+    a partial cache file.'''
+    cacheName = CacheFileName(fileName, sim)
+    try:
+        os.makedirs(CACHEDIR, exist_ok=True)
+        with open(cacheName + f'.{os.getpid()}', 'wb') as cache:
+            pickle.dump((key, benchmarks), cache, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cacheName + f'.{os.getpid()}', cacheName)
+    except OSError as err:
+        print(f'Warning: could not cache {fileName}: {err}', file=sys.stderr)
+
+def ProcessFileJob(job):
+    '''ProcessFile in a pool worker.  Returns the cache key taken before parsing, so a transcript that
+    changes while it is read is not cached under its new mtime.'''
+    (fileName, sim) = job
+    key = CacheKey(fileName, sim)
+    return (key, ProcessFile(fileName, sim))
+
+def ProcessFiles(fileNames, sim, jobs, useCache):
+    '''ProcessFile every transcript, in order.  Cached transcripts are read from the cache; the rest are
+    parsed in parallel by a pool of jobs processes and then cached.'''
+    results = [ReadCache(fileName, sim) if useCache else None for fileName in fileNames]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if len(missing) > 1 and jobs > 1:
+        with Pool(processes=min(jobs, len(missing))) as pool:
+            parsed = pool.map(ProcessFileJob, [(fileNames[i], sim) for i in missing], chunksize=1)
+    else:
+        parsed = [ProcessFileJob((fileNames[i], sim)) for i in missing]
+    for i, (key, benchmarks) in zip(missing, parsed):
+        results[i] = benchmarks
+        if useCache: WriteCache(fileNames[i], sim, key, benchmarks)
+    return results
+
+def IsDataBase(path):
+    with open(path, 'rb') as source:
+        return source.read(len(SQLITEMAGIC)) == SQLITEMAGIC
+
+def GitRevision():
+    '''The git revision of $WALLY, or '' if it is not a git checkout.'''
+    try:
+        return subprocess.run(['git', '-C', WALLY or '.', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def IngestDataBase(dbName, predictorLogs, allPerformanceCounters, sim, rev, date):
+    '''Add the counters of each transcript to the database as a run tagged with its predictor configuration, the
+    simulator, git revision and date (the transcript's mtime unless given).  A transcript already ingested with the
+    same size and mtime is skipped.  Returns the number of runs added.'''
+    added = 0
+    with sqlite3.connect(dbName) as db:
+        db.executescript(DBSCHEMA)
+        for ((predictorLog, predictorType, predictorParams), benchmarks) in zip(predictorLogs, allPerformanceCounters):
+            info = os.stat(predictorLog)
+            runDate = date or datetime.fromtimestamp(info.st_mtime).isoformat(timespec='seconds')
+            cursor = db.execute('INSERT OR IGNORE INTO runs (log, size, mtime, config, type, params, simulator, rev, date) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (os.path.abspath(predictorLog), info.st_size, info.st_mtime_ns, GenerateName(predictorType, predictorParams),
+                                 predictorType, ' '.join(predictorParams), sim, rev, runDate))
+            if cursor.rowcount == 0: continue
+            db.executemany('INSERT INTO counters (run, benchmark, opt, name, value) VALUES (?, ?, ?, ?, ?)',
+                           ((cursor.lastrowid, testName, opt, name, value)
+                            for (testName, opt, HPMClist) in benchmarks for (name, value) in HPMClist.items()))
+            added += 1
+    return added
+
+def QueryDataBase(dbName, sim, rev, since, until, history):
+    '''Select runs of the simulator from the database, optionally only a git revision (prefix) or a date range, and
+    return them as ParseBranchListFile's list with the runs' ProcessFile outputs and labels.  Only the latest run of
+    each config is kept, in the order the configs were first ingested, unless history asks for all of them by date;
+    then each run is labeled with its date and revision.'''
+    conditions = ['simulator = ?']
+    parameters = [sim]
+    # until compares only as much of the date as it gives, so a bare date includes that whole day
+    for (condition, value) in (('rev LIKE ?', rev and rev + '%'), ('date >= ?', since), ('substr(date, 1, length(?)) <= ?', until)):
+        if value:
+            conditions.append(condition)
+            parameters += [value] * condition.count('?')
+    with sqlite3.connect(f'file:{dbName}?mode=ro', uri=True) as db:
+        runs = db.execute(f'SELECT id, log, config, type, params, rev, date FROM runs WHERE {" AND ".join(conditions)} ORDER BY date, id',
+                          parameters).fetchall()
+        if not history:
+            latest = {}
+            first = {}
+            for run in runs:
+                latest[run[2]] = run
+                first[run[2]] = min(first.get(run[2], run[0]), run[0])
+            runs = [latest[config] for config in sorted(first, key=first.get)]
+        allPerformanceCounters = {run[0]: {} for run in runs}
+        for (runId, testName, opt, name, value) in db.execute(
+                f'SELECT run, benchmark, opt, name, value FROM counters WHERE run IN ({",".join("?" * len(runs))}) ORDER BY rowid',
+                [run[0] for run in runs]):
+            allPerformanceCounters[runId].setdefault((testName, opt), {})[name] = value
+    predictorLogs = [[log, predictorType, params.split()] for (runId, log, config, predictorType, params, runRev, date) in runs]
+    labels = [f'{date[:10]}_{runRev[:8]}' if history else None for (runId, log, config, predictorType, params, runRev, date) in runs]
+    return (predictorLogs, [[(testName, opt, HPMClist) for ((testName, opt), HPMClist) in allPerformanceCounters[run[0]].items()] for run in runs], labels)
+
+
+class CounterStore:
+    '''The performance counters of every benchmark under every branch predictor configuration, as one array
+    data[config, benchmark, counter] with NaN where a transcript has no value.  configs holds (name, displayName,
+    entries, size) tuples, benchmarks (testName, opt) pairs in order of first appearance and counters the counter
+    names; derived metrics are appended as counters.  mean maps each averaged metric to its geometric mean per config.'''
+    def __init__(self, configs, transcripts):
+        benchmarks = {}
+        counters = {}
+        for trace in transcripts:
+            for (testName, opt, HPMClist) in trace:
+                benchmarks.setdefault((testName, opt), len(benchmarks))
+                for name in HPMClist: counters.setdefault(name, len(counters))
+        self.configs = configs
+        self.benchmarks = list(benchmarks)
+        self.counters = list(counters)
+        self.data = np.full((len(configs), len(benchmarks), len(counters)), np.nan)
+        for (config, trace) in enumerate(transcripts):
+            for (testName, opt, HPMClist) in trace:
+                columns = [counters[name] for name in HPMClist]
+                self.data[config, benchmarks[(testName, opt)], columns] = list(HPMClist.values())
+        self.mean = {}
+
+    def __getitem__(self, name):
+        '''The config x benchmark array of one counter or metric; all NaN if no transcript reported it.'''
+        if name not in self.counters: return np.full(self.data.shape[:2], np.nan)
+        return self.data[:, :, self.counters.index(name)]
+
+    def __setitem__(self, name, values):
+        if name in self.counters:
+            self.data[:, :, self.counters.index(name)] = values
+        else:
+            self.data = np.concatenate((self.data, values[:, :, np.newaxis]), axis=2)
+            self.counters.append(name)
+
+def Ratio(numerator, denominator, scale=1.0):
+    '''scale * numerator / denominator, NaN where the denominator is 0 or either is missing.'''
+    result = np.full(np.shape(numerator), np.nan)
+    np.divide(scale * numerator, denominator, out=result, where=(denominator != 0))
+    return result
+
+def ComputeStats(store):
+    store['CPI'] = Ratio(store['Mcycle'], store['InstRet'])
+    store['BDMR'] = Ratio(store['BP Dir Wrong'], store['Br Count'], 100.0)
+    store['BTMR'] = Ratio(store['BP Target Wrong'], store['Br Count'] + store['Jump Not Return'], 100.0)
+    store['RASMPR'] = Ratio(store['RAS Wrong'], store['Return'], 100.0)
+    store['ClassMPR'] = Ratio(store['Instr Class Wrong'], store['InstRet'], 100.0)
+    store['ICacheMR'] = Ratio(store['I Cache Miss'], store['I Cache Access'], 100.0)
+    # miss times are 0 rather than undefined when there are no misses
+    store['ICacheMT'] = np.where(store['I Cache Miss'] == 0, 0.0, Ratio(store['I Cache Cycles'], store['I Cache Miss'], 100.0))
+    store['DCacheMR'] = Ratio(store['D Cache Miss'], store['D Cache Access'], 100.0)
+    store['DCacheMT'] = np.where(store['D Cache Miss'] == 0, 0.0, Ratio(store['D Cache Cycles'], store['D Cache Miss'], 100.0))
+
+def ComputeGeometricAverage(store):
+    '''Geometric mean over the benchmarks of each config, summing logs so long products cannot overflow.  Missing
+    values are left out; zeros count as benchmarks but add nothing to the sum, since they would zero the mean.'''
     fields = ['BDMR', 'BTMR', 'RASMPR', 'ClassMPR', 'ICacheMR', 'DCacheMR', 'CPI', 'ICacheMT', 'DCacheMT']
-    AllAve = {}
     for field in fields:
-        Product = 1
-        index = 0
-        for (testName, opt, HPMCList) in benchmarks:
-            #print(HPMCList)
-            value = HPMCList[field]
-            if(value != 0): Product *= value # if that value is 0 exclude from mean because it destories the geo mean
-            index += 1
-        AllAve[field] = Product ** (1.0/index)
-    benchmarks.append(('Mean', '', AllAve))
+        values = store[field]
+        present = ~np.isnan(values)
+        logs = np.log(values, out=np.zeros_like(values), where=present & (values > 0))
+        count = present.sum(axis=1)
+        store.mean[field] = np.exp(Ratio(logs.sum(axis=1), count))
 
 def GenerateName(predictorType, predictorParams):
     if(predictorType == 'gshare' or  predictorType == 'twobit' or predictorType == 'btb' or predictorType == 'class' or predictorType == 'ras' or predictorType == 'global'):
@@ -164,71 +329,50 @@ def ComputePredSize(predictorType, predictorParams):
         print(f'Error unsupported predictor type {predictorType}')
         sys.exit(-1)
 
-def BuildDataBase(predictorLogs):
-    # Once done with the following loop, performanceCounterList will contain the predictor type and size along with the
-    # raw performance counter data and the processed data on a per benchmark basis.  It also includes the geometric mean.
-    # list
-    #   branch predictor configuration 0 (tuple)
-    #     benchmark name
-    #     compiler optimization
-    #     data (dictionary)
-    #       dictionary of performance counters
-    #   branch predictor configuration 1 (tuple)
-    #     benchmark name (dictionary)
-    #     compiler optimization
-    #     data
-    #       dictionary of performance counters
-    # ...
-    performanceCounterList = []
-    for trace in predictorLogs:
-        predictorLog = trace[0]
-        predictorType = trace[1]
-        predictorParams = trace[2]
-        # Extract the performance counter data
-        performanceCounters = ProcessFile(predictorLog)
-        ComputeStats(performanceCounters)
-        ComputeGeometricAverage(performanceCounters)
-        #print(performanceCounters)
-        performanceCounterList.append([GenerateName(predictorType, predictorParams), GenerateDisplayName(predictorType, predictorParams), performanceCounters, ComputePredNumEntries(predictorType, predictorParams), ComputePredSize(predictorType, predictorParams)])
-    return performanceCounterList
-
-def ReorderDataBase(performanceCounterList):
-    # Reorder the data so the benchmark name comes first, then the branch predictor configuration
-    benchmarkFirstList = []
-    for (predictorName, predictorPrefixName, benchmarks, entries, size) in performanceCounterList:
-        for benchmark in benchmarks:
-            (nameString, opt, dataDict) = benchmark
-            benchmarkFirstList.append((nameString, opt, predictorName, predictorPrefixName, entries, size, dataDict))
-    return benchmarkFirstList
-
-def ExtractSelectedData(benchmarkFirstList):
-    # now extract all branch prediction direction miss rates for each
-    # namestring + opt, config
+def BuildDataBase(predictorLogs, allPerformanceCounters, labels):
+    # Returns a CounterStore holding the raw performance counters and the derived metrics of every benchmark under
+    # every branch predictor configuration (the predictor type and size), along with the geometric means.
+    # A config with a label (a run from the counter database's history) is named <config>@<label>.
+    configs = [(GenerateName(predictorType, predictorParams) + (f'@{label}' if label else ''), GenerateDisplayName(predictorType, predictorParams),
+                ComputePredNumEntries(predictorType, predictorParams), ComputePredSize(predictorType, predictorParams))
+               for ((predictorLog, predictorType, predictorParams), label) in zip(predictorLogs, labels)]
+    store = CounterStore(configs, allPerformanceCounters)
+    ComputeStats(store)
+    ComputeGeometricAverage(store)
+    return store
+
+def ExtractSelectedData(store, metric):
+    # now extract the metric (e.g. branch prediction direction miss rates) for each benchmark name and config.
+    # Returns the configs and a dictionary from benchmark name to the (config indices, values) where it has a value,
+    # config-major; benchmarks of the same name with different optimizations share a name, and 'Mean' comes last.
+    values = store[metric]
+    configIndex = np.broadcast_to(np.arange(len(store.configs))[:, np.newaxis], values.shape)
+    # use this code to distinguish speed opt and size opt.
+    #if opt == 'bd_speedopt_speed': NewName = name+'Sp'
+    #elif opt == 'bd_sizeopt_speed': NewName = name+'Sz'
+    #else: NewName = name
     benchmarkDict = { }
-    for benchmark in benchmarkFirstList:
-        (name, opt, config, prefixName, entries, size, dataDict) = benchmark
-        #print(f'config = {config}, prefixName = {prefixName} entries = {entries}')
-        # use this code to distinguish speed opt and size opt.
-        #if opt == 'bd_speedopt_speed': NewName = name+'Sp'
-        #elif opt == 'bd_sizeopt_speed': NewName = name+'Sz'
-        #else: NewName = name
-        NewName = name
-        #print(NewName)
-        #NewName = name+'_'+opt
-        if NewName in benchmarkDict:
-            benchmarkDict[NewName].append((config, prefixName, entries, size, dataDict[ReportPredictorType]))
-        else:
-            benchmarkDict[NewName] = [(config, prefixName, entries, size, dataDict[ReportPredictorType])]
-    return benchmarkDict
-
-def ReportAsTable(benchmarkDict):
-    refLine = benchmarkDict['Mean']
-    FirstLine = []
-    SecondLine = []
-    for Elements in refLine:
-        (name, typ, size, entries, val) = Elements
-        FirstLine.append(name)
-        SecondLine.append(entries if not args.size else size)
+    for NewName in dict.fromkeys(name for (name, opt) in store.benchmarks):
+        columns = [index for (index, (name, opt)) in enumerate(store.benchmarks) if name == NewName]
+        selected = values[:, columns].ravel()
+        present = ~np.isnan(selected)
+        benchmarkDict[NewName] = (configIndex[:, columns].ravel()[present], selected[present])
+    benchmarkDict['Mean'] = (np.arange(len(store.configs)), store.mean[metric])
+    return (list(store.configs), benchmarkDict)
+
+def AddReference(configs, benchmarkDict, refData):
+    # append the reference model's means as more configs
+    (configIndex, values) = benchmarkDict['Mean']
+    start = len(configs)
+    configs.extend((name, typ, entries, size) for (name, typ, entries, size, val) in refData)
+    benchmarkDict['Mean'] = (np.concatenate((configIndex, np.arange(start, len(configs)))),
+                             np.concatenate((values, [val for (name, typ, entries, size, val) in refData])))
+
+def ReportAsTable(configs, benchmarkDict):
+    (refIndex, refValues) = benchmarkDict['Mean']
+    # the size row shows sizes by default and entries with --size, as it always has
+    FirstLine = [configs[config][0] for config in refIndex]
+    SecondLine = [configs[config][3 if not args.size else 2] for config in refIndex]
 
     sys.stdout.write('benchmark\t\t')
     for name in FirstLine:
@@ -243,8 +387,7 @@ def ReportAsTable(benchmarkDict):
 
     if(args.summary):
         sys.stdout.write('Mean\t\t\t')
-        for (name, typ, size, entries, val) in refLine:
-            sys.stdout.write('%0.2f\t\t' % (val if not args.invert else 100 - val))
+        sys.stdout.write(''.join(f'{val:0.2f}\t\t' for val in Inversion(refValues)))
         sys.stdout.write('\n')
 
     if(not args.summary):
@@ -253,27 +396,32 @@ def ReportAsTable(benchmarkDict):
             if(length < 8): sys.stdout.write(f'{benchmark}\t\t\t')
             elif(length < 16): sys.stdout.write(f'{benchmark}\t\t')
             else: sys.stdout.write(f'{benchmark}\t')
-            for (name, typ, entries, size, val) in benchmarkDict[benchmark]:
-                sys.stdout.write('%0.2f\t\t' % (val if not args.invert else 100 -val))
+            sys.stdout.write(''.join(f'{val:0.2f}\t\t' for val in Inversion(benchmarkDict[benchmark][1])))
             sys.stdout.write('\n')
 
-def ReportAsText(benchmarkDict):
+def ReportAsText(configs, benchmarkDict):
     if(args.summary):
-        mean = benchmarkDict['Mean']
         print('Mean')
-        for (name, typ, entries, size, val) in mean:
-            sys.stdout.write(f'{name} {entries if not args.size else size} {val if not args.invert else 100 - val:0.2f}\n')
+        ReportLines(configs, *benchmarkDict['Mean'])
 
     if(not args.summary):
         for benchmark in benchmarkDict:
             print(benchmark)
-            for (name, prefixName, entries, size, val) in benchmarkDict[benchmark]:
-                sys.stdout.write(f'{name} {entries if not args.size else size} {val if not args.invert else 100 - val:0.2f}\n')
+            ReportLines(configs, *benchmarkDict[benchmark])
+
+def ReportLines(configs, configIndex, values):
+    for (config, val) in zip(configIndex, Inversion(values)):
+        (name, _, entries, size) = configs[config]
+        sys.stdout.write(f'{name} {entries if not args.size else size} {val:0.2f}\n')
 
-def Inversion(lst):
-    return [x if not args.invert else 100 - x for x in lst]
+def Inversion(values):
+    return 100 - np.asarray(values) if args.invert else np.asarray(values)
 
-def BarGraph(seriesDict, xlabelList, BenchPerRow, FileName, IncludeLegend):
+def BarGraph(seriesDict, xlabelList, BenchPerRow, FileName, IncludeLegend, invert):
+    # runs in a worker process of ReportAsGraph, so it always renders to a file with the Agg backend
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
     index = 0
     NumberInGroup = len(seriesDict)
     # Figure out width of bars.  NumberInGroup bars + want 2 bar space
@@ -286,14 +434,18 @@ def BarGraph(seriesDict, xlabelList, BenchPerRow, FileName, IncludeLegend):
         values = seriesDict[name]
         xpos = np.arange(len(values))
         xpos = [x + index*barWidth for x in xpos]
-        plt.bar(xpos, Inversion(values), width=barWidth, edgecolor='grey', label=name, color=colors[index%len(colors)])
+        plt.bar(xpos, [x if not invert else 100 - x for x in values], width=barWidth, edgecolor='grey', label=name, color=colors[index%len(colors)])
         index += 1
     plt.xticks([r + barWidth*(NumberInGroup/2-0.5) for r in range(0, BenchPerRow)], xlabelList)
     plt.xlabel('Benchmark')
-    if(not args.invert): plt.ylabel('Misprediction Rate (%)')
+    if(not invert): plt.ylabel('Misprediction Rate (%)')
     else:  plt.ylabel('Prediction Accuracy (%)')
     if(IncludeLegend): plt.legend(loc='upper right', ncol=2)
     plt.savefig(FileName)
+    plt.close()
+
+def RenderBarGraph(job):
+    BarGraph(*job)
 
 def SelectPartition(xlabelListBig, seriesDictBig, group, BenchPerRow):
     seriesDictTrunk = {}
@@ -304,7 +456,7 @@ def SelectPartition(xlabelListBig, seriesDictBig, group, BenchPerRow):
     return(xlabelListTrunk, seriesDictTrunk)
 
 
-def ReportAsGraph(benchmarkDict, bar, FileName):
+def ReportAsGraph(configs, benchmarkDict, bar, FileName):
     def FormatToPlot(currBenchmark):
         names = []
         sizes = []
@@ -332,14 +484,16 @@ def ReportAsGraph(benchmarkDict, bar, FileName):
         # branch predictors with various parameterizations
         # group the parameterizations by the common typ.
         sequences = {}
-        for (name, typ, entries, size, value) in benchmarkDict['Mean']:
+        for (config, value) in zip(*benchmarkDict['Mean']):
+            (name, typ, entries, size) = configs[config]
             if typ not in sequences:
                 sequences[typ] = [(entries if not args.size else int(size/8), value)]
             else:
                 sequences[typ].append((entries if not args.size else int(size/8) ,value))
         # then graph the common typ as a single line+scatter plot
         # finally repeat for all typs of branch predictors and overlay
-        fig, axes = plt.subplots()
+        import matplotlib.pyplot as plt
+        _, axes = plt.subplots()
         index = 0
         if(args.invert): plt.title(titlesInvert[ReportPredictorType])
         else: plt.title(titles[ReportPredictorType])
@@ -395,7 +549,8 @@ def ReportAsGraph(benchmarkDict, bar, FileName):
         for benchmarkName in benchmarkDict:
             currBenchmark = benchmarkDict[benchmarkName]
             xlabelList.append(benchmarkName)
-            for (name, typ, entries, size, value) in currBenchmark:
+            for (config, value) in zip(*currBenchmark):
+                name = configs[config][0]
                 if(name not in seriesDict):
                     seriesDict[name] = [value]
                 else:
@@ -408,100 +563,112 @@ def ReportAsGraph(benchmarkDict, bar, FileName):
         for benchmarkName in benchmarkDict:
             currBenchmark = benchmarkDict[benchmarkName]
             xlabelListBig.append(benchmarkName)
-            for (name, typ, entries, size, value) in currBenchmark:
+            for (config, value) in zip(*currBenchmark):
+                name = configs[config][0]
                 if(name not in seriesDictBig):
                     seriesDictBig[name] = [value]
                 else:
                     seriesDictBig[name].append(value)
 
         #The next step will be to split the benchmarkDict into length BenchPerRow pieces then repeat the following code
-        # on each piece.
+        # on each piece.  The pieces are rendered in parallel.
+        jobs = []
         for row in range(0, math.ceil(NumBenchmarks / BenchPerRow)):
             (xlabelListTrunk, seriesDictTrunk) = SelectPartition(xlabelListBig, seriesDictBig, row, BenchPerRow)
             FileName = f'barSegment{row}.svg'
             groupLen = len(xlabelListTrunk)
-            BarGraph(seriesDictTrunk, xlabelListTrunk, groupLen, FileName, (row == 0))
-
-
-# main
-parser = argparse.ArgumentParser(description='Parses performance counters from a Questa Sim trace to produce a graph or graphs.')
-
-# parse program arguments
-metric = parser.add_mutually_exclusive_group()
-metric.add_argument('-r', '--ras', action='store_const', help='Plot return address stack (RAS) performance.', default=False, const=True)
-metric.add_argument('-d', '--direction', action='store_const', help='Plot direction prediction (2-bit, Gshare, local, etc) performance.', default=False, const=True)
-metric.add_argument('-t', '--target', action='store_const', help='Plot branch target buffer (BTB) performance.', default=False, const=True)
-metric.add_argument('-c', '--iclass', action='store_const', help='Plot instruction classification performance.', default=False, const=True)
-
-parser.add_argument('-s', '--summary', action='store_const', help='Show only the geometric average for all benchmarks.', default=False, const=True)
-parser.add_argument('-b', '--bar', action='store_const', help='Plot graphs.', default=False, const=True)
-parser.add_argument('-g', '--reference', action='store_const', help='Include the golden reference model from branch-predictor-simulator. Data stored statically at the top of %(prog)s.  If you need to regenreate use CModelBranchAcurracy.sh', default=False, const=True)
-parser.add_argument('-i', '--invert', action='store_const', help='Invert metric. Example Branch miss prediction becomes prediction accuracy. 100 - miss rate', default=False, const=True)
-parser.add_argument('--size', action='store_const', help='Display x-axis as size in bits rather than number of table entries', default=False, const=True)
-
-displayMode = parser.add_mutually_exclusive_group()
-displayMode.add_argument('--text', action='store_const', help='Display in text format only.', default=False, const=True)
-displayMode.add_argument('--table', action='store_const', help='Display in text format only.', default=False, const=True)
-displayMode.add_argument('--gui', action='store_const', help='Display in text format only.', default=False, const=True)
-displayMode.add_argument('--debug', action='store_const', help='Display in text format only.', default=False, const=True)
-parser.add_argument('sources', nargs=1, help='File lists the input Questa transcripts to process.')
-parser.add_argument('sim', choices=["questa", "verilator", "vcs"], help='Simulator that was used to generate logs. This is used to find the files specified in the sources file.')
-parser.add_argument('FileName', metavar='FileName', type=str, nargs='?', help='output graph to file <name>.png If not included outputs to screen.', default=None)
-
-args = parser.parse_args()
-
-# Figure what we are reporting
-ReportPredictorType = 'BDMR'  # default
-if(args.ras): ReportPredictorType = 'RASMPR'
-if(args.target): ReportPredictorType = 'BTMR'
-if(args.iclass): ReportPredictorType = 'ClassMPR'
-
-# Figure how we are displaying the data
-ReportMode = 'gui' # default
-if(args.text): ReportMode = 'text'
-if(args.table): ReportMode = 'table'
-if(args.debug): ReportMode = 'debug'
-
-# read the questa sim list file.
-# row, col format.  each row is a questa sim run with performance counters and a particular
-# branch predictor type and size. size can be multiple parameters for more complex predictors like
-# local history and tage.
-# <file> <type> <size>
-predictorLogs = ParseBranchListFile(args.sources[0])          # digests the traces
-performanceCounterList = BuildDataBase(predictorLogs)         # builds a database of performance counters by trace and then by benchmark
-benchmarkFirstList = ReorderDataBase(performanceCounterList)  # reorder first by benchmark then trace
-benchmarkDict = ExtractSelectedData(benchmarkFirstList)       # filters to just the desired performance counter metric
-
-if(args.reference and args.direction): benchmarkDict['Mean'].extend(RefDataBP)
-if(args.reference and args.target): benchmarkDict['Mean'].extend(RefDataBTB)
-#print(benchmarkDict['Mean'])
-#print(benchmarkDict['aha-mont64Speed'])
-#print(benchmarkDict)
-
-# table format
-if(ReportMode == 'table'):
-    ReportAsTable(benchmarkDict)
-
-if(ReportMode == 'text'):
-    ReportAsText(benchmarkDict)
-
-if(ReportMode == 'gui'):
-    ReportAsGraph(benchmarkDict, args.bar, args.FileName)
-
-# *** this is only needed of -b (no -s)
-
-# debug
-#config0 = performanceCounterList[0][0]
-#data0 = performanceCounterList[0][1]
-#bench0 = data0[0]
-#bench0name = bench0[0]
-#bench0data = bench0[2]
-#bench0BrCount = bench0data['Br Count']
-#bench1 = data0[1]
-
-#print(data0)
-#print(bench0)
-#print(bench1)
-
-#print(bench0name)
-#print(bench0BrCount)
+            jobs.append((seriesDictTrunk, xlabelListTrunk, groupLen, FileName, (row == 0), args.invert))
+        with Pool(processes=max(1, min(args.jobs, len(jobs)))) as pool:
+            pool.map(RenderBarGraph, jobs, chunksize=1)
+
+
+def ParseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Parses performance counters from a Questa Sim trace to produce a graph or graphs.')
+
+    # parse program arguments
+    metric = parser.add_mutually_exclusive_group()
+    metric.add_argument('-r', '--ras', action='store_const', help='Plot return address stack (RAS) performance.', default=False, const=True)
+    metric.add_argument('-d', '--direction', action='store_const', help='Plot direction prediction (2-bit, Gshare, local, etc) performance.', default=False, const=True)
+    metric.add_argument('-t', '--target', action='store_const', help='Plot branch target buffer (BTB) performance.', default=False, const=True)
+    metric.add_argument('-c', '--iclass', action='store_const', help='Plot instruction classification performance.', default=False, const=True)
+
+    parser.add_argument('-s', '--summary', action='store_const', help='Show only the geometric average for all benchmarks.', default=False, const=True)
+    parser.add_argument('-b', '--bar', action='store_const', help='Plot graphs.', default=False, const=True)
+    parser.add_argument('-g', '--reference', action='store_const', help='Include the golden reference model from branch-predictor-simulator. Data stored statically at the top of %(prog)s.  If you need to regenreate use CModelBranchAcurracy.sh', default=False, const=True)
+    parser.add_argument('-i', '--invert', action='store_const', help='Invert metric. Example Branch miss prediction becomes prediction accuracy. 100 - miss rate', default=False, const=True)
+    parser.add_argument('--size', action='store_const', help='Display x-axis as size in bits rather than number of table entries', default=False, const=True)
+
+    displayMode = parser.add_mutually_exclusive_group()
+    displayMode.add_argument('--text', action='store_const', help='Display in text format only.', default=False, const=True)
+    displayMode.add_argument('--table', action='store_const', help='Display in text format only.', default=False, const=True)
+    displayMode.add_argument('--gui', action='store_const', help='Display in text format only.', default=False, const=True)
+    displayMode.add_argument('--debug', action='store_const', help='Display in text format only.', default=False, const=True)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of transcripts parsed in parallel.')
+    parser.add_argument('--no-cache', action='store_const', help=f'Reparse every transcript instead of reusing the parses cached in {CACHEDIR}.', default=False, const=True)
+    parser.add_argument('--ingest', metavar='DB', help='Also add the counters of the transcripts to the SQLite counter database DB, which can later be given as sources.')
+    parser.add_argument('--tag-rev', help='Git revision the ingested transcripts are tagged with (default: the revision of $WALLY).')
+    parser.add_argument('--tag-date', help='ISO date the ingested transcripts are tagged with (default: each transcript\'s modification time).')
+    parser.add_argument('--rev', help='With a counter database as sources, only report runs of this git revision (or revision prefix).')
+    parser.add_argument('--since', help='With a counter database as sources, only report runs dated on or after this ISO date.')
+    parser.add_argument('--until', help='With a counter database as sources, only report runs dated on or before this ISO date.')
+    parser.add_argument('--history', action='store_const', help='With a counter database as sources, report every matching run of each config, oldest first, named <config>@<date>_<rev>, instead of only the latest.', default=False, const=True)
+    parser.add_argument('sources', nargs=1, help='File lists the input Questa transcripts to process, or a counter database written by --ingest.')
+    parser.add_argument('sim', choices=["questa", "verilator", "vcs"], help='Simulator that was used to generate logs. This is used to find the files specified in the sources file.')
+    parser.add_argument('FileName', metavar='FileName', type=str, nargs='?', help='output graph to file <name>.png If not included outputs to screen.', default=None)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    global args, ReportPredictorType
+    args = ParseArgs(argv)
+
+    # Figure what we are reporting
+    ReportPredictorType = 'BDMR'  # default
+    if(args.ras): ReportPredictorType = 'RASMPR'
+    if(args.target): ReportPredictorType = 'BTMR'
+    if(args.iclass): ReportPredictorType = 'ClassMPR'
+
+    # Figure how we are displaying the data
+    ReportMode = 'gui' # default
+    if(args.text): ReportMode = 'text'
+    if(args.table): ReportMode = 'table'
+    if(args.debug): ReportMode = 'debug'
+
+    # read the questa sim list file.
+    # row, col format.  each row is a questa sim run with performance counters and a particular
+    # branch predictor type and size. size can be multiple parameters for more complex predictors like
+    # local history and tage.
+    # <file> <type> <size>
+    # The sources can instead be a counter database, in which case the runs selected from it replace the transcripts.
+    if IsDataBase(args.sources[0]):
+        (predictorLogs, allPerformanceCounters, labels) = QueryDataBase(args.sources[0], args.sim, args.rev, args.since, args.until, args.history)
+        if not predictorLogs:
+            print(f'Error: no {args.sim} runs in {args.sources[0]} match')
+            return 1
+    else:
+        predictorLogs = ParseBranchListFile(args.sources[0])      # digests the traces
+        # Extract the performance counter data of all the traces at once so they are parsed in parallel
+        allPerformanceCounters = ProcessFiles([trace[0] for trace in predictorLogs], args.sim, args.jobs, not args.no_cache)
+        labels = [None] * len(predictorLogs)
+        if args.ingest:
+            added = IngestDataBase(args.ingest, predictorLogs, allPerformanceCounters, args.sim, args.tag_rev or GitRevision(), args.tag_date)
+            print(f'Ingested {added} of {len(predictorLogs)} transcripts into {args.ingest}', file=sys.stderr)
+    store = BuildDataBase(predictorLogs, allPerformanceCounters, labels) # builds an array of performance counters by trace, benchmark and counter
+    (configs, benchmarkDict) = ExtractSelectedData(store, ReportPredictorType) # slices out just the desired performance counter metric
+
+    if(args.reference and args.direction): AddReference(configs, benchmarkDict, RefDataBP)
+    if(args.reference and args.target): AddReference(configs, benchmarkDict, RefDataBTB)
+
+    # table format
+    if(ReportMode == 'table'):
+        ReportAsTable(configs, benchmarkDict)
+
+    if(ReportMode == 'text'):
+        ReportAsText(configs, benchmarkDict)
+
+    # matplotlib is only imported for graphs
+    if(ReportMode == 'gui'):
+        ReportAsGraph(configs, benchmarkDict, args.bar, args.FileName)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -163,6 +163,13 @@ module loggers import cvw::*; #(parameter cvw_t P,
     end
   end
 
+  // cycle stamp on the I$ and D$ log records so CacheSim.py can interleave the two logs
+  // to simulate a shared L2.  The count is never reset, so it increases across TRAIN/BEGIN.
+  longint unsigned CacheLogCycle = 0;
+  if ((P.ICACHE_SUPPORTED & I_CACHE_ADDR_LOGGER) | (P.DCACHE_SUPPORTED & D_CACHE_ADDR_LOGGER)) begin : CacheLogCycleCounter
+    always @(posedge clk) CacheLogCycle <= CacheLogCycle + 1;
+  end
+
   if (P.ICACHE_SUPPORTED & I_CACHE_ADDR_LOGGER) begin : ICacheLogger
     int    file;
     string LogFile;
@@ -195,9 +202,9 @@ module loggers import cvw::*; #(parameter cvw_t P,
     if(resetEdge) $fwrite(file, "TRAIN\n");
     if(BeginSample) $fwrite(file, "BEGIN %s\n", memfilename);
     if(Enable) begin  // only log i cache reads
-      $fwrite(file, "%h R %s\n", dut.core.ifu.PCPF, HitMissString);
+      $fwrite(file, "%h R %s %0d\n", dut.core.ifu.PCPF, HitMissString, CacheLogCycle);
     end
-    if(InvalEdge) $fwrite(file, "0 I X\n");
+    if(InvalEdge) $fwrite(file, "0 I X %0d\n", CacheLogCycle);
     if(EndSample) $fwrite(file, "END %s\n", memfilename);
     end
   end
@@ -244,9 +251,9 @@ module loggers import cvw::*; #(parameter cvw_t P,
       if(resetEdge) $fwrite(file, "TRAIN\n");
       if(BeginSample) $fwrite(file, "BEGIN %s\n", memfilename);
       if(Enabled) begin
-        $fwrite(file, "%h %s %s\n", dut.core.lsu.PAdrM, AccessTypeString, HitMissString);
+        $fwrite(file, "%h %s %s %0d\n", dut.core.lsu.PAdrM, AccessTypeString, HitMissString, CacheLogCycle);
       end
-      if(dut.core.lsu.bus.dcache.dcache.cachefsm.FlushFlag) $fwrite(file, "0 F X\n");
+      if(dut.core.lsu.bus.dcache.dcache.cachefsm.FlushFlag) $fwrite(file, "0 F X %0d\n", CacheLogCycle);
       if(EndSample) $fwrite(file, "END %s\n", memfilename);
     end
   end
@@ -283,7 +290,8 @@ module loggers import cvw::*; #(parameter cvw_t P,
         end
         if((|dut.core.ifu.IClassM) & ~dut.core.StallW & ~dut.core.FlushW & dut.core.InstrValidM) begin
           direction = PCSrcM ? "t" : "n";
-          $fwrite(CFIfile, "%h %s\n", dut.core.PCM, direction);
+          // instruction class {call, return, jump, branch} and target for BranchSim.py's BTB and RAS models
+          $fwrite(CFIfile, "%h %s %h %h\n", dut.core.PCM, direction, dut.core.ifu.IClassM, dut.core.IEUAdrM);
         end
         if(EndSample) begin
           $fwrite(file, "END %s\n", memfilename);